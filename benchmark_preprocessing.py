@@ -0,0 +1,182 @@
+'''
+Throughput benchmark of the preprocessing and merge steps on synthetic ATL03 granules.
+Every step is run in a fresh process, so the peak RSS reported is that of the step alone.
+'''
+import os, sys, argparse
+import json, time, platform, resource, tempfile, shutil
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BASE_DIR)
+sys.path.append(os.path.join(BASE_DIR, 'preprocessing'))
+
+
+def parse_args():
+    '''PARAMETERS'''
+    parser = argparse.ArgumentParser('Preprocessing benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000],
+                        help='photons per strong beam of the synthetic granules')
+    parser.add_argument('--granules', type=int, default=1, help='number of granules per size')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each step, the fastest one is reported')
+    parser.add_argument('--npoint', type=int, default=8192, help='points per sub-file for splitting')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes of the conversion')
+    parser.add_argument('--chunkSize', type=int, default=None, help='stream the conversion in chunks of this size')
+    parser.add_argument('--format', type=str, default='csv', help='format of the beam files (csv, parquet, feather)')
+    parser.add_argument('--work_dir', type=str, default=None, help='scratch directory [default: a temporary one]')
+    parser.add_argument('--output', type=str, default=None, help='json file for the results [default: stdout]')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss / scale
+
+
+def step_convert(data_dir, args):
+    import ATL03_h5_to_csv
+    shutil.rmtree(os.path.join(data_dir, 'csv_data'), ignore_errors=True)
+    ATL03_h5_to_csv.convert(data_dir, utm=True, removeLand=True, removeIrrelevant=True, workers=args.workers,
+                            chunkSize=args.chunkSize, outFormat=args.format, force=True)
+
+
+def step_split(data_dir, args):
+    import generate_training_data
+    from data_utils.table_io import is_table
+    output_dir = os.path.join(data_dir, 'input_data')
+    shutil.rmtree(output_dir, ignore_errors=True)
+    csv_dir = os.path.join(data_dir, 'csv_data')
+    file_list = [os.path.join(csv_dir, f) for f in sorted(os.listdir(csv_dir)) if is_table(f)]
+    generate_training_data.split_by_npoints(file_list, output_dir, mode='test', npoints=args.npoint)
+
+
+def step_merge(data_dir, args):
+    import post_process
+    output_dir = os.path.join(data_dir, 'output_merge')
+    shutil.rmtree(output_dir, ignore_errors=True)
+    post_process.merge(os.path.join(data_dir, 'output'), output_dir, args.format)
+
+
+STEPS = {'convert': step_convert, 'split_by_npoints': step_split, 'merge': step_merge}
+
+
+def run_step(name, data_dir, args, queue):
+    start = time.perf_counter()
+    STEPS[name](data_dir, args)
+    queue.put((time.perf_counter() - start, peak_rss_mb()))
+
+
+def measure(name, data_dir, args):
+    # spawn rather than fork, so the child doesn't start out with the memory of the benchmark process
+    ctx = multiprocessing.get_context('spawn')
+    best = None
+    for _ in range(args.repeat):
+        queue = ctx.Queue()
+        process = ctx.Process(target=run_step, args=(name, data_dir, args, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError('%s failed with exit code %d' % (name, process.exitcode))
+        if best is None or result[0] < best[0]:
+            best = result
+    return best
+
+
+def fake_predictions(data_dir):
+    # Stand-in for predict.py: the .txt sub-files in input_data with a random probability and prediction, in its format.
+    # input_data also holds the tile index and summary of the split, which are skipped
+    input_dir = os.path.join(data_dir, 'input_data')
+    output_dir = os.path.join(data_dir, 'output')
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.mkdir(output_dir)
+    rng = np.random.default_rng(0)
+    for fn in sorted(fn for fn in os.listdir(input_dir) if os.path.splitext(fn)[1] == '.txt'):
+        data = np.loadtxt(os.path.join(input_dir, fn))
+        prob = rng.random(len(data))
+        output_points = np.column_stack([data[:, 0:6], prob, prob > 0.5])
+        np.savetxt(os.path.join(output_dir, os.path.splitext(fn)[0] + '.csv'), output_points, delimiter=',',
+                   header='x,y,elev,lon,lat,class,prob,pred', fmt='%.4f')
+
+
+def count_rows(directory, reader):
+    return sum(len(reader(os.path.join(directory, fn))) for fn in os.listdir(directory))
+
+
+def benchmark_size(size, work_dir, args):
+    import synthetic_ATL03
+    from data_utils.table_io import read_table, is_table
+    data_dir = os.path.join(work_dir, 'photons_%d' % size)
+    shutil.rmtree(data_dir, ignore_errors=True)
+    filenames = synthetic_ATL03.generate(data_dir, granules=args.granules, photons=size, seed=args.seed)
+
+    import h5py
+    h5_photons = 0
+    for filename in filenames:
+        with h5py.File(filename, mode='r') as fileID:
+            h5_photons += sum(fileID[gtx]['heights']['h_ph'].shape[0] for gtx in synthetic_ATL03.BEAMS)
+
+    results = []
+
+    def record(step, photons, seconds, rss):
+        results.append({'size': size, 'step': step, 'photons': int(photons), 'seconds': seconds,
+                        'photons_per_sec': photons / seconds if seconds > 0 else None, 'peak_rss_mb': rss})
+        print('%8d %-16s %10d photons %8.3f s %12.0f photons/s %8.1f MB' %
+              (size, step, photons, seconds, photons / seconds, rss), file=sys.stderr)
+
+    # The photons read from the granules, the photons in the beam files and the photons in the sub-files
+    seconds, rss = measure('convert', data_dir, args)
+    record('convert', h5_photons, seconds, rss)
+    csv_dir = os.path.join(data_dir, 'csv_data')
+    beam_photons = sum(len(read_table(os.path.join(csv_dir, fn))) for fn in os.listdir(csv_dir) if is_table(fn))
+
+    seconds, rss = measure('split_by_npoints', data_dir, args)
+    record('split_by_npoints', beam_photons, seconds, rss)
+
+    fake_predictions(data_dir)
+    merge_photons = count_rows(os.path.join(data_dir, 'output'), pd.read_csv)
+    seconds, rss = measure('merge', data_dir, args)
+    record('merge', merge_photons, seconds, rss)
+
+    return results
+
+
+def main(args):
+    work_dir = args.work_dir if args.work_dir else tempfile.mkdtemp(prefix='benchmark_')
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    results = []
+    try:
+        for size in args.sizes:
+            results.extend(benchmark_size(size, work_dir, args))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'settings': {'granules': args.granules, 'repeat': args.repeat, 'npoint': args.npoint, 'workers': args.workers,
+                     'chunkSize': args.chunkSize, 'format': args.format, 'seed': args.seed},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -8,28 +8,52 @@ import os, math
 import json
 import warnings
 import numpy as np
+import pandas as pd
 from torch.utils.data import Dataset
 import torch
+from data_utils.shard_io import ShardReader, load_tile
 warnings.filterwarnings('ignore')
 
 
-def pc_normalize(pc):
-    pc_min = np.empty(3, dtype=np.float64)
-    pc_max = np.empty(3, dtype=np.float64)
-    for i in range(pc.shape[1]):
-        pc_min[i] = min(pc[:, i])
-        pc_max[i] = max(pc[:, i])
-        pc[:, i] = 2 * ((pc[:, i] - pc_min[i]) / (pc_max[i] - pc_min[i])) - 1
-    return pc, pc_min, pc_max
+def pc_normalize(pc, pc_min=None, pc_max=None):
+    # Scale each column of pc to [-1, 1] between pc_min and pc_max (the min/max of pc if not given). Returns a new array,
+    # pc itself (which may be a cached or memory mapped tile) is left as it is
+    if pc_min is None:
+        pc_min = pc.min(axis=0)
+    if pc_max is None:
+        pc_max = pc.max(axis=0)
+    return 2 * ((pc - pc_min) / (pc_max - pc_min)) - 1, pc_min, pc_max
+
+
+def pc_denormalize(pc, pc_min, pc_max):
+    pc[:] = (pc + 1) / 2 * (pc_max - pc_min) + pc_min
+    return pc
 
 
 class PartNormalDataset(Dataset):
-    def __init__(self, root='./data', npoints=8192, split='train', conf_channel=True):
+    def __init__(self, root='./data', npoints=8192, split='train', conf_channel=True, packed=False, npy_cache=True,
+                 in_memory=False):
         self.npoints = npoints
         self.root = root
         self.split = split
         self.conf_channel = conf_channel
-
+        self.packed = packed
+        # .txt tiles are converted to .npy once and memory mapped after that, shared by all workers, epochs and runs
+        self.cache_dir = os.path.join(self.root, 'npy_cache') if npy_cache and not packed else None
+        self.points = None
+
+        if self.packed:
+            # tiles packed into shards by train_val_test_split.py --pack, read with memory mapping
+            self.init_shards(['train', 'val'] if self.split == 'trainval' else [self.split])
+        else:
+            self.init_files()
+        self.load_tile_index()
+        if in_memory:
+            # all tiles loaded once into shared memory
+            self.load_in_memory()
+
+    def init_files(self):
+        # .txt tiles in input_data, selected by the file lists of train_val_test_split.py
         with open(os.path.join(self.root, 'train_test_split', 'train_file_list.json'), 'r') as f:
             train_ids = set([str(d) for d in json.load(f)])
         with open(os.path.join(self.root, 'train_test_split', 'val_file_list.json'), 'r') as f:
@@ -49,22 +73,119 @@ class PartNormalDataset(Dataset):
         elif self.split == 'test':
             fns = [fn for fn in fns if fn in test_ids]
         else:
-            print('Unknown split: %s. Exiting..' % (split))
+            print('Unknown split: %s. Exiting..' % (self.split))
             exit(-1)
         for fn in fns:
             if os.path.splitext(os.path.basename(fn))[1] == '.txt':
                 self.datapath.append(os.path.join(dir_point, fn))
 
         self.cache = {}
-        self.cache_size = 20000
+        self.cache_size = 0 if self.cache_dir else 20000
+        self.bounds = {}
+
+    def init_shards(self, splits):
+        dir_point = os.path.join(self.root, 'input_data')
+        self.shards = [ShardReader(dir_point, split) for split in splits]
+        self.datapath = []
+        self.tiles = {}
+        for shard in self.shards:
+            for i, name in enumerate(shard.names()):
+                self.datapath.append(name)
+                self.tiles[name] = (shard, i)
+        # the shards are memory mapped, so there is nothing to gain from caching tiles
+        self.cache = {}
+        self.cache_size = 0
+        self.bounds = {}
+
+    def load_tile_index(self):
+        # Bounds and seafloor photon counts of the tiles from the tile_index.csv written next to them by
+        # generate_training_data.py, if there is one. Tiles that aren't in it are read to find their bounds
+        self.index_bounds = {}
+        self.seafloor = {}
+        index_file = os.path.join(self.root, 'input_data', 'tile_index.csv')
+        if not os.path.exists(index_file):
+            return
+        # round_trip, so the bounds are exactly those of the tile
+        index = pd.read_csv(index_file, float_precision='round_trip').drop_duplicates('name', keep='last')
+        index = index.set_index('name')
+        index = index.reindex([os.path.basename(fn) for fn in self.datapath])
+        # the normalization bounds are those of the first three columns of the tile, whatever they hold; indexes
+        # written before they were recorded only have bounds by column name, which don't follow the tile layout
+        if 'norm0_min' in index.columns:
+            mins = index[['norm0_min', 'norm1_min', 'norm2_min']].to_numpy()
+            maxs = index[['norm0_max', 'norm1_max', 'norm2_max']].to_numpy()
+            for fn, pc_min, pc_max, npoints in zip(self.datapath, mins, maxs, index['npoints'].to_numpy()):
+                if not np.isnan(npoints):
+                    self.index_bounds[fn] = (pc_min, pc_max, int(npoints))
+        if 'seafloor' in index.columns:
+            for fn, seafloor in zip(self.datapath, index['seafloor'].to_numpy()):
+                if not np.isnan(seafloor):
+                    self.seafloor[fn] = int(seafloor)
+
+    def has_seafloor(self, fn):
+        # from the tile index, the shard index or else the _seafloor suffix that generate_annotation gives such tiles
+        if fn in self.seafloor:
+            return self.seafloor[fn] > 0
+        if self.packed:
+            shard, i = self.tiles[fn]
+            return bool(shard.index['has_seafloor'].iat[i])
+        return 'seafloor' in os.path.basename(fn)
+
+    def sample_weights(self):
+        # weights for a WeightedRandomSampler that draws tiles with and without seafloor equally often
+        has_seafloor = np.array([self.has_seafloor(fn) for fn in self.datapath], dtype=bool)
+        n_seafloor = np.count_nonzero(has_seafloor)
+        if n_seafloor == 0 or n_seafloor == len(has_seafloor):
+            return np.ones(len(has_seafloor))
+        return np.where(has_seafloor, 0.5 / n_seafloor, 0.5 / (len(has_seafloor) - n_seafloor))
+
+    def load_in_memory(self):
+        # All tiles in one tensor in shared memory, with the offset of each tile. The DataLoader workers read the tiles
+        # from this block instead of each keeping a cache of their own
+        tiles = [np.atleast_2d(self.read_tile(fn)) for fn in self.datapath]
+        self.offsets = np.cumsum([0] + [len(tile) for tile in tiles])
+        self.points = torch.empty((self.offsets[-1], tiles[0].shape[1]), dtype=torch.float64).share_memory_()
+        for i, tile in enumerate(tiles):
+            self.points[self.offsets[i]:self.offsets[i + 1]] = torch.from_numpy(np.asarray(tile))
+        self.tile_ids = {fn: i for i, fn in enumerate(self.datapath)}
+        self.cache = {}
+        self.cache_size = 0
+
+    def read_tile(self, fn):
+        # all columns of a tile, from memory, its .txt file or the shard it was packed into
+        if self.points is not None:
+            i = self.tile_ids[fn]
+            return self.points[self.offsets[i]:self.offsets[i + 1]].numpy()
+        if self.packed:
+            shard, i = self.tiles[fn]
+            return shard.read(i)
+        return load_tile(fn, self.cache_dir)
+
+    def tile_bounds(self, fn, point_set):
+        # min/max of the first three columns (x,y,elev) of a tile, from the shard index, the tile index or computed on the
+        # first read of the tile
+        if fn not in self.bounds:
+            # the shard index has the float64 bounds of the original tile, which its float32 points don't give back
+            bounds = self.tiles[fn][0].bounds(self.tiles[fn][1]) if self.packed else None
+            if bounds is not None:
+                self.bounds[fn] = (bounds[0][0:3], bounds[1][0:3])
+                return self.bounds[fn]
+            self.bounds[fn] = (point_set[:, 0:3].min(axis=0), point_set[:, 0:3].max(axis=0))
+            bounds = None if self.packed else self.index_bounds.get(fn)
+            # a tile index entry is only used if it matches the tile, which is checked once, on its first read; a stale
+            # entry, or one of another tile layout, falls back to the bounds of the tile itself
+            if bounds is not None and bounds[2] == len(point_set) and np.array_equal(bounds[0], self.bounds[fn][0]) \
+                    and np.array_equal(bounds[1], self.bounds[fn][1]):
+                self.bounds[fn] = bounds[:2]
+        return self.bounds[fn]
 
     def __getitem__(self, index):
+        fn = self.datapath[index]
         if index in self.cache:
             point_set, cls, seg = self.cache[index]
         else:
-            fn = self.datapath[index]
             cls = np.array([0]).astype(np.int32)
-            data = np.loadtxt(fn).astype(np.float64)
+            data = self.read_tile(fn)
             if not self.conf_channel:
                 point_set = data[:, [0, 1, 2]]  # use x,y,elev
             else:
@@ -76,16 +197,18 @@ class PartNormalDataset(Dataset):
             if len(self.cache) < self.cache_size:
                 self.cache[index] = (point_set, cls, seg)
 
-        point_set_normalized = point_set
-        point_set_normalized[:, 0:3], pc_min, pc_max = pc_normalize(point_set[:, 0:3])
+        pc_min, pc_max = self.tile_bounds(fn, point_set)
 
         point_set_normalized_mask = np.full(self.npoints, True, dtype=bool)
         # resample
         if len(seg) > self.npoints:
             choice = np.random.choice(len(seg), self.npoints, replace=False)
-            point_set_normalized = point_set_normalized[choice, :]
+            point_set = point_set[choice, :]
             seg = seg[choice]
-        elif len(seg) < self.npoints:
+        # normalized with the bounds of the whole tile, into a new array so the cached tile stays as it is
+        point_set_normalized = np.concatenate((pc_normalize(point_set[:, 0:3], pc_min, pc_max)[0], point_set[:, 3:]),
+                                              axis=1)
+        if len(seg) < self.npoints:
             if not self.conf_channel:
                 pad_point = np.ones((self.npoints-len(seg), 3), dtype=np.float32)
             else:
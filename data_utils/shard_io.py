@@ -0,0 +1,165 @@
+'''
+Packed tile shards: all tiles of a split in one float32 point file and one int8 label file, plus an index of the tiles
+(source beam, tile number, offset, point count, has_seafloor, min/max of the points). A shard replaces a directory of small .txt tiles and is
+read with memory mapping.
+'''
+import os, re
+import json
+import numpy as np
+import pandas as pd
+
+# Columns of a tile, in the order of the .txt tiles written by split_by_npoints
+POINT_COLUMNS = ['x', 'y', 'elev', 'lon', 'lat']
+LABEL_COLUMNS = ['class', 'signal_conf_ph', 'annotation']
+TILE_COLUMNS = POINT_COLUMNS + LABEL_COLUMNS
+
+
+def shard_paths(shard_dir, split):
+    return {'points': os.path.join(shard_dir, split + '_points.bin'),
+            'labels': os.path.join(shard_dir, split + '_labels.bin'),
+            'index': os.path.join(shard_dir, split + '_index.csv'),
+            'meta': os.path.join(shard_dir, split + '_meta.json')}
+
+
+def shard_exists(shard_dir, split):
+    return os.path.exists(shard_paths(shard_dir, split)['index'])
+
+
+def tile_name_parts(name):
+    # source beam and tile number of a tile file name, e.g. ATL03_..._gt1l_raw_17N_03_seafloor.txt -> (ATL03_..._17N, 3)
+    match = re.search(r'^(.*[NS])_(\d+)', os.path.basename(name))
+    if match:
+        return match.group(1), int(match.group(2))
+    return os.path.splitext(os.path.basename(name))[0], 0
+
+
+class ShardWriter:
+    # Appends tiles to the shard of a split. Points are stored relative to the minimum of their tile (its origin, kept in
+    # float64 in the index), so float32 keeps sub-millimetre precision on UTM coordinates. The files are written under a
+    # temporary name and only replace an existing shard on close
+    def __init__(self, shard_dir, split):
+        if not os.path.exists(shard_dir):
+            os.makedirs(shard_dir)
+        self.paths = shard_paths(shard_dir, split)
+        self.f_points = open(self.paths['points'] + '.tmp', 'wb')
+        self.f_labels = open(self.paths['labels'] + '.tmp', 'wb')
+        self.index = []
+        self.offset = 0
+
+    def add(self, name, data):
+        # data holds the columns of TILE_COLUMNS (without annotation for unlabelled tiles), as in a .txt tile
+        data = np.asarray(data, dtype=np.float64).reshape(-1, data.shape[-1])
+        points = data[:, :len(POINT_COLUMNS)]
+        labels = np.zeros((len(data), len(LABEL_COLUMNS)), dtype=np.int8)
+        labels[:, :data.shape[1] - len(POINT_COLUMNS)] = data[:, len(POINT_COLUMNS):len(TILE_COLUMNS)]
+        origin = points.min(axis=0) if len(points) else np.zeros(len(POINT_COLUMNS))
+        maximum = points.max(axis=0) if len(points) else np.zeros(len(POINT_COLUMNS))
+        self.f_points.write((points - origin).astype(np.float32).tobytes())
+        self.f_labels.write(labels.tobytes())
+
+        beam, tile = tile_name_parts(name)
+        entry = {'name': name, 'beam': beam, 'tile': tile, 'offset': self.offset, 'npoints': len(data),
+                 'has_seafloor': bool(np.any(labels[:, -1] != 0))}
+        for column, value in zip(POINT_COLUMNS, origin):
+            entry[column + '_origin'] = value
+        for column, value in zip(POINT_COLUMNS, maximum):
+            entry[column + '_max'] = value
+        self.index.append(entry)
+        self.offset += len(data)
+
+    def close(self):
+        self.f_points.close()
+        self.f_labels.close()
+        meta = {'point_columns': POINT_COLUMNS, 'label_columns': LABEL_COLUMNS, 'point_dtype': 'float32',
+                'label_dtype': 'int8', 'ntiles': len(self.index), 'npoints': self.offset}
+        os.replace(self.paths['points'] + '.tmp', self.paths['points'])
+        os.replace(self.paths['labels'] + '.tmp', self.paths['labels'])
+        with open(self.paths['meta'], 'w') as f:
+            json.dump(meta, f, indent=2)
+        # the index goes last, so a shard with an index is complete
+        pd.DataFrame(self.index, columns=['name', 'beam', 'tile', 'offset', 'npoints', 'has_seafloor'] +
+                     [column + '_origin' for column in POINT_COLUMNS] +
+                     [column + '_max' for column in POINT_COLUMNS]).to_csv(self.paths['index'], index=False)
+
+
+class ShardReader:
+    # Memory mapped access to the tiles of a shard. The files are mapped on first access, so every DataLoader worker maps
+    # them itself instead of receiving a copy of the arrays
+    def __init__(self, shard_dir, split):
+        self.paths = shard_paths(shard_dir, split)
+        # round_trip, so the origins and maxima are exactly those of the original tiles
+        self.index = pd.read_csv(self.paths['index'], float_precision='round_trip')
+        with open(self.paths['meta'], 'r') as f:
+            self.meta = json.load(f)
+        self.origins = self.index[[column + '_origin' for column in POINT_COLUMNS]].to_numpy()
+        # shards packed before the maxima were recorded have no _max columns
+        max_columns = [column + '_max' for column in POINT_COLUMNS]
+        self.maxima = self.index[max_columns].to_numpy() if set(max_columns) <= set(self.index.columns) else None
+        self.points = None
+        self.labels = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['points'] = None
+        state['labels'] = None
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def names(self):
+        return self.index['name'].tolist()
+
+    def open(self):
+        if self.points is None:
+            self.points = np.memmap(self.paths['points'], dtype=self.meta['point_dtype'], mode='r')
+            self.points = self.points.reshape(-1, len(self.meta['point_columns']))
+            self.labels = np.memmap(self.paths['labels'], dtype=self.meta['label_dtype'], mode='r')
+            self.labels = self.labels.reshape(-1, len(self.meta['label_columns']))
+
+    def bounds(self, i):
+        # min and max of the point columns of tile i in float64, as computed from the original tile, or None
+        if self.maxima is None:
+            return None
+        return self.origins[i], self.maxima[i]
+
+    def read(self, i):
+        # tile i as a float64 array with the columns of TILE_COLUMNS, like np.loadtxt of a labelled .txt tile
+        self.open()
+        start = self.index['offset'].iat[i]
+        stop = start + self.index['npoints'].iat[i]
+        data = np.empty((stop - start, len(TILE_COLUMNS)), dtype=np.float64)
+        data[:, :len(POINT_COLUMNS)] = self.points[start:stop] + self.origins[i]
+        data[:, len(POINT_COLUMNS):] = self.labels[start:stop]
+        return data
+
+
+def load_tile(fn, cache_dir=None):
+    # np.loadtxt of a .txt tile. With cache_dir, the tile is converted to .npy the first time it is read and memory mapped
+    # after that, by every DataLoader worker and every later run. A tile is converted again when its .txt file is newer
+    if cache_dir is None:
+        return np.loadtxt(fn).astype(np.float64)
+    cache_file = os.path.join(cache_dir, os.path.splitext(os.path.basename(fn))[0] + '.npy')
+    try:
+        if os.stat(cache_file).st_mtime_ns >= os.stat(fn).st_mtime_ns:
+            return np.load(cache_file, mmap_mode='r')
+    except (OSError, ValueError):
+        # no cached copy yet, or a broken one
+        pass
+    data = np.loadtxt(fn).astype(np.float64)
+    os.makedirs(cache_dir, exist_ok=True)
+    # workers converting the same tile at the same time each write their own file; the last rename wins
+    tmp_file = cache_file + '.%d.tmp' % os.getpid()
+    with open(tmp_file, 'wb') as f:
+        np.save(f, data)
+    os.replace(tmp_file, cache_file)
+    return data
+
+
+def pack_tiles(file_list, shard_dir, split):
+    # Pack .txt tiles into the shard of a split
+    writer = ShardWriter(shard_dir, split)
+    for fn in file_list:
+        writer.add(os.path.basename(fn), np.loadtxt(fn, ndmin=2))
+    writer.close()
+    return shard_paths(shard_dir, split)
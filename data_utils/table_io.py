@@ -0,0 +1,70 @@
+'''
+Reading and writing of the beam tables passed between the preprocessing, prediction and merge steps.
+Tables can be stored as csv or, with pyarrow installed, as Parquet or Feather (Arrow IPC); the format
+follows from the file extension.
+'''
+import os
+import pandas as pd
+
+TABLE_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+
+def table_format(path):
+    ext = os.path.splitext(path)[1]
+    for fmt, fmt_ext in TABLE_FORMATS.items():
+        if ext == fmt_ext:
+            return fmt
+    raise ValueError('Unknown table format: %s' % path)
+
+
+def is_table(path):
+    return os.path.splitext(path)[1] in TABLE_FORMATS.values()
+
+
+def read_table(path, columns=None):
+    fmt = table_format(path)
+    if fmt == 'parquet':
+        return pd.read_parquet(path, columns=columns)
+    elif fmt == 'feather':
+        return pd.read_feather(path, columns=columns)
+    return pd.read_csv(path, usecols=columns)
+
+
+def write_table(df, path):
+    fmt = table_format(path)
+    if fmt == 'parquet':
+        df.to_parquet(path, index=False)
+    elif fmt == 'feather':
+        df.reset_index(drop=True).to_feather(path)
+    else:
+        df.to_csv(path, index=False)
+
+
+class TableWriter:
+    # Writes a table in parts. The columns and dtypes are fixed by template (which may be empty), so a table
+    # without any rows is still written with its header/schema
+    def __init__(self, path, template):
+        self.path = path
+        self.format = table_format(path)
+        self.writer = None
+        if self.format == 'csv':
+            template.iloc[:0].to_csv(path, index=False)
+        else:
+            import pyarrow as pa
+            self.schema = pa.Schema.from_pandas(template.iloc[:0], preserve_index=False)
+            if self.format == 'parquet':
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(path, self.schema)
+            else:
+                self.writer = pa.ipc.new_file(path, self.schema)
+
+    def write(self, df):
+        if self.format == 'csv':
+            df.to_csv(self.path, mode='a', header=False, index=False)
+        else:
+            import pyarrow as pa
+            self.writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
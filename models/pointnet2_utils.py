@@ -40,6 +40,61 @@ def square_distance(src, dst):
     return dist
 
 
+# Memory budget in bytes of the pairwise distances (and the temporaries reducing them) that exist at a time in
+# square_distance_chunks; the full distance matrix is never built
+DISTANCE_MEMORY_BUDGET = 64 * 1024 ** 2
+
+
+def chunk_rows(row_bytes):
+    # rows of row_bytes each that fit in DISTANCE_MEMORY_BUDGET, at least one
+    return max(1, int(DISTANCE_MEMORY_BUDGET // max(row_bytes, 1)))
+
+
+def square_distance_chunks(src, dst, element_bytes=4):
+    """
+    square_distance of src and dst in chunks of src, each chunk of distances within DISTANCE_MEMORY_BUDGET. The caller
+    reduces each chunk before the next one is computed. The distances equal those of the unchunked square_distance up
+    to float rounding: matmul may round differently for another shape, so their last bits, and with them ties and
+    points right on a radius, can depend on the chunk size, i.e. on the budget
+    Input:
+        src: source points, [B, N, C]
+        dst: target points, [B, M, C]
+        element_bytes: memory per distance of the chunk and of its reduction
+    Return:
+        generator of (start, dist), dist the square distances of src[:, start:start + n], [B, n, M]
+    """
+    B, N, _ = src.shape
+    _, M, _ = dst.shape
+    # at least 16 rows per chunk: a small budget or a large M would otherwise give a matmul call for every row or two.
+    # matmul rounds a single row differently from a matrix, so a lone last row is joined to the chunk before it
+    n = max(chunk_rows(B * M * element_bytes), 16)
+    start = 0
+    while start < N:
+        stop = start + n if start + n != N - 1 else N
+        yield start, square_distance(src[:, start:stop], dst)
+        start = stop
+
+
+def three_nn(xyz1, xyz2):
+    """
+    The three nearest points in xyz2 of every point in xyz1, nearest first. Takes the top 3 of the distances of a
+    chunk of xyz1 at a time, instead of sorting the full [B, N, S] distance matrix. The distances are those of the sort;
+    points at the same distance may come in another order, which changes the interpolation in the last bits
+    Input:
+        xyz1: points, [B, N, C]
+        xyz2: points to search, [B, S, C]
+    Return:
+        dists: square distances, [B, N, 3]
+        idx: indices in xyz2, [B, N, 3]
+    """
+    dists, idx = [], []
+    for start, chunk in square_distance_chunks(xyz1, xyz2, element_bytes=8):
+        chunk_dists, chunk_idx = torch.topk(chunk, 3, dim=-1, largest=False, sorted=True)
+        dists.append(chunk_dists)
+        idx.append(chunk_idx)
+    return torch.cat(dists, dim=1), torch.cat(idx, dim=1)
+
+
 def index_points(points, idx):
     """
 
@@ -70,9 +125,11 @@ def farthest_point_sample(xyz, npoint):
     """
     device = xyz.device
     B, N, C = xyz.shape
+    farthest = torch.randint(0, N, (B,), dtype=torch.long).to(device)
+    if device.type == 'cpu':
+        return farthest_point_sample_cpu(xyz, npoint, farthest)
     centroids = torch.zeros(B, npoint, dtype=torch.long).to(device)
     distance = torch.ones(B, N).to(device) * 1e10
-    farthest = torch.randint(0, N, (B,), dtype=torch.long).to(device)
     batch_indices = torch.arange(B, dtype=torch.long).to(device)
     for i in range(npoint):
         centroids[:, i] = farthest
@@ -84,6 +141,61 @@ def farthest_point_sample(xyz, npoint):
     return centroids
 
 
+def farthest_point_sample_cpu(xyz, npoint, farthest):
+    """
+    farthest_point_sample on the CPU, with the same result. The coordinates are kept as separate contiguous planes and
+    every step works in place on preallocated buffers, instead of allocating [B, N, 3] temporaries and scattering
+    through a mask
+    Input:
+        xyz: pointcloud data, [B, N, 3]
+        npoint: number of samples
+        farthest: index of the first sample, [B]
+    Return:
+        centroids: sampled pointcloud index, [B, npoint]
+    """
+    B, N, C = xyz.shape
+    planes = xyz.permute(2, 0, 1).contiguous()  # [C, B, N]
+    centroids = torch.zeros(B, npoint, dtype=torch.long)
+    distance = torch.full((B, N), 1e10, dtype=xyz.dtype)
+    dist = torch.empty_like(distance)
+    diff = torch.empty_like(distance)
+    batch_indices = torch.arange(B, dtype=torch.long)
+    for i in range(npoint):
+        centroids[:, i] = farthest
+        centroid = xyz[batch_indices, farthest, :]  # [B, C]
+        torch.sub(planes[0], centroid[:, 0:1], out=dist)
+        dist.mul_(dist)
+        for c in range(1, C):
+            torch.sub(planes[c], centroid[:, c:c + 1], out=diff)
+            diff.mul_(diff)
+            dist.add_(diff)
+        torch.minimum(distance, dist, out=distance)
+        farthest = torch.max(distance, -1)[1]
+    return centroids
+
+
+def group_ball_pairs(query, idx, nsample, B, S, N):
+    """
+    The first nsample points of each query point by point index, padded with the first one as in query_ball_point
+    Input:
+        query: flat query point index of each pair, [P]
+        idx: point index of each pair, [P]
+        nsample: max sample number in local region
+    Return:
+        group_idx: grouped points index, [B, S, nsample]
+    """
+    count = torch.bincount(query, minlength=B * S)
+    rank = torch.arange(len(query), dtype=torch.long).to(query.device) - \
+        (torch.cumsum(count, 0) - count).index_select(0, query)
+    first = torch.nonzero(rank < nsample).view(-1)
+    group_idx = torch.full((B * S, nsample), N, dtype=torch.long).to(query.device)
+    group_idx[query.index_select(0, first), rank.index_select(0, first)] = idx.index_select(0, first)
+    group_first = group_idx[:, 0:1].repeat([1, nsample])
+    mask = group_idx == N
+    group_idx[mask] = group_first[mask]
+    return group_idx.view(B, S, nsample)
+
+
 def query_ball_point(radius, nsample, xyz, new_xyz):
     """
     Input:
@@ -94,17 +206,58 @@ def query_ball_point(radius, nsample, xyz, new_xyz):
     Return:
         group_idx: grouped points index, [B, S, nsample]
     """
-    device = xyz.device
+    return query_ball_point_msg([radius], [nsample], xyz, new_xyz)[0]
+
+
+def group_ball_pairs_msg(query, idx, sqrdists, radius_list, nsample_list, B, S, N):
+    """
+    group_ball_pairs of each radius, from the pairs within the largest one
+    Input:
+        query: flat query point index of each pair, [P]
+        idx: point index of each pair, [P]
+        sqrdists: square distance of each pair, [P]
+        radius_list: local region radii
+        nsample_list: max sample number in local region of each radius
+    Return:
+        group_idx_list: grouped points index of each radius, [B, S, nsample]
+    """
+    max_radius = max(radius_list)
+    group_idx_list = []
+    for radius, nsample in zip(radius_list, nsample_list):
+        if radius < max_radius:
+            within = torch.nonzero(sqrdists <= radius ** 2).view(-1)
+            group_idx_list.append(group_ball_pairs(query.index_select(0, within), idx.index_select(0, within),
+                                                   nsample, B, S, N))
+        else:
+            group_idx_list.append(group_ball_pairs(query, idx, nsample, B, S, N))
+    return group_idx_list
+
+
+def query_ball_point_msg(radius_list, nsample_list, xyz, new_xyz):
+    """
+    query_ball_point for several radii at once, from the [B, S, N] distances, reduced in chunks of query points as they
+    are computed: the pairs within the largest radius are taken from each chunk and grouped for every radius, so the
+    distances are computed once and the per-radius work is on the pairs only. The chunks leave room for every point
+    being within the largest radius
+    Input:
+        radius_list: local region radii
+        nsample_list: max sample number in local region of each radius
+        xyz: all points, [B, N, 3]
+        new_xyz: query points, [B, S, 3]
+    Return:
+        group_idx_list: grouped points index of each radius, [B, S, nsample]
+    """
     B, N, C = xyz.shape
-    _, S, _ = new_xyz.shape
-    group_idx = torch.arange(N, dtype=torch.long).to(device).view(1, 1, N).repeat([B, S, 1])
-    sqrdists = square_distance(new_xyz, xyz)
-    group_idx[sqrdists > radius ** 2] = N
-    group_idx = group_idx.sort(dim=-1)[0][:, :, :nsample]
-    group_first = group_idx[:, :, 0].view(B, S, 1).repeat([1, 1, nsample])
-    mask = group_idx == N
-    group_idx[mask] = group_first[mask]
-    return group_idx
+    max_radius = max(radius_list)
+    chunks = [[] for _ in radius_list]
+    for start, sqrdists in square_distance_chunks(new_xyz, xyz, element_bytes=40):
+        n = sqrdists.shape[1]
+        # nonzero is in (b, s, n) order, so the pairs are sorted by query, then point index
+        b, s, idx = torch.nonzero(sqrdists <= max_radius ** 2, as_tuple=True)
+        groups = group_ball_pairs_msg(b * n + s, idx, sqrdists[b, s, idx], radius_list, nsample_list, B, n, N)
+        for chunk, group_idx in zip(chunks, groups):
+            chunk.append(group_idx)
+    return [torch.cat(chunk, dim=1) for chunk in chunks]
 
 
 def sample_and_group(npoint, radius, nsample, xyz, points, returnfps=False):
@@ -237,24 +390,24 @@ class PointNetSetAbstractionMsg(nn.Module):
         B, N, C = xyz.shape
         S = self.npoint
         new_xyz = index_points(xyz, farthest_point_sample(xyz, S))
+        # the groups of all radii from one neighbour query, gathered at once
+        group_idx = torch.cat(query_ball_point_msg(self.radius_list, self.nsample_list, xyz, new_xyz), dim=-1)
+        grouped_xyz = index_points(xyz, group_idx)
+        grouped_xyz -= new_xyz.view(B, S, 1, C)
+        if points is not None:
+            grouped_points = index_points(points, group_idx)
+            grouped_points = torch.cat([grouped_points, grouped_xyz], dim=-1)
+        else:
+            grouped_points = grouped_xyz
+
         new_points_list = []
-        for i, radius in enumerate(self.radius_list):
-            K = self.nsample_list[i]
-            group_idx = query_ball_point(radius, K, xyz, new_xyz)
-            grouped_xyz = index_points(xyz, group_idx)
-            grouped_xyz -= new_xyz.view(B, S, 1, C)
-            if points is not None:
-                grouped_points = index_points(points, group_idx)
-                grouped_points = torch.cat([grouped_points, grouped_xyz], dim=-1)
-            else:
-                grouped_points = grouped_xyz
-
-            grouped_points = grouped_points.permute(0, 3, 2, 1)  # [B, D, K, S]
+        for i, scale_points in enumerate(torch.split(grouped_points, self.nsample_list, dim=2)):
+            scale_points = scale_points.permute(0, 3, 2, 1)  # [B, D, K, S]
             for j in range(len(self.conv_blocks[i])):
                 conv = self.conv_blocks[i][j]
                 bn = self.bn_blocks[i][j]
-                grouped_points =  F.relu(bn(conv(grouped_points)))
-            new_points = torch.max(grouped_points, 2)[0]  # [B, D', S]
+                scale_points =  F.relu(bn(conv(scale_points)))
+            new_points = torch.max(scale_points, 2)[0]  # [B, D', S]
             new_points_list.append(new_points)
 
         new_xyz = new_xyz.permute(0, 2, 1)
@@ -293,9 +446,7 @@ class PointNetFeaturePropagation(nn.Module):
         if S == 1:
             interpolated_points = points2.repeat(1, N, 1)
         else:
-            dists = square_distance(xyz1, xyz2)
-            dists, idx = dists.sort(dim=-1)
-            dists, idx = dists[:, :, :3], idx[:, :, :3]  # [B, N, 3]
+            dists, idx = three_nn(xyz1, xyz2)  # [B, N, 3]
 
             dist_recip = 1.0 / (dists + 1e-8)
             norm = torch.sum(dist_recip, dim=2, keepdim=True)
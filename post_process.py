@@ -4,7 +4,9 @@ Date: Jul 2023
 '''
 import os, argparse
 import re
+import numpy as np
 import pandas as pd
+from data_utils.table_io import read_table, write_table, TABLE_FORMATS
 
 
 def refraction_correction_approx(b_z, w_z):
@@ -19,18 +21,69 @@ def parse_args():
     parser.add_argument('--data_dir', type=str, help='input data directory')
     parser.add_argument('--file_list', type=str, default='file_list.txt', help='a list of original files in txt format')
     parser.add_argument('--output_dir', type=str, help='output directory')
+    parser.add_argument('--format', type=str, default='csv', choices=list(TABLE_FORMATS),
+                        help='output format of the merged beam files')
+    parser.add_argument('--tile_index', type=str, default=None,
+                        help='tile_index.csv of the sub-files, to average the probabilities of overlapping sub-files')
+    parser.add_argument('--threshold', type=float, default=0.5, help='probability threshold')
 
     return parser.parse_args()
 
 
-def main(args):
-    log_dir = args.log_dir
-    input_dir = os.path.join(log_dir, args.data_dir)
-    output_dir = os.path.join(log_dir, args.output_dir)
+def tile_weights(npoints):
+    # weight of each point of a sub-file when averaging overlapping predictions: highest in the middle, where the point
+    # has the most context, and falling off linearly towards both ends
+    return 1 - np.abs((np.arange(npoints) + 0.5) / npoints * 2 - 1)
+
+
+def merge_tiles(input_dir, output_dir, tile_index, out_format='csv', threshold=0.5):
+    # Stitch the predicted sub-files of each beam back together using the photon ranges in tile_index. Photons predicted
+    # in several (overlapping) sub-files get the weighted average of their probabilities, and are classified again
+    df_index = pd.read_csv(tile_index)
+    for beam, df_beam in df_index.groupby('beam', sort=False):
+        values, columns = None, None
+        prob_sum = np.zeros(df_beam['stop'].max())
+        weight_sum = np.zeros(df_beam['stop'].max())
+        count = np.zeros(df_beam['stop'].max(), dtype=np.int64)
+        for name, start in zip(df_beam['name'], df_beam['start']):
+            sub_file = os.path.join(input_dir, os.path.splitext(name)[0] + '.csv')
+            if not os.path.exists(sub_file):
+                continue
+            df_sub_file = read_table(sub_file)
+            if values is None:
+                columns = df_sub_file.columns
+                values = np.zeros((len(prob_sum), len(columns)))
+            index = np.arange(start, start + len(df_sub_file))
+            weights = tile_weights(len(df_sub_file))
+            values[index] = df_sub_file.to_numpy()
+            prob_sum[index] += weights * df_sub_file['prob'].to_numpy()
+            weight_sum[index] += weights
+            count[index] += 1
+        if values is None:
+            continue
+
+        # photons predicted only once keep their probability and prediction as they are
+        predicted = count > 0
+        overlap = count[predicted] > 1
+        df = pd.DataFrame(values[predicted], columns=columns)
+        prob = prob_sum[predicted] / weight_sum[predicted]
+        df['prob'] = np.where(overlap, prob, df['prob'])
+        df['pred'] = np.where(overlap, np.where(prob < threshold, 0, 1), df['pred']).astype(int)
+        if 'label' in df.columns:
+            df['label'] = df['label'].astype(int)
+        output_file = os.path.join(output_dir, beam + TABLE_FORMATS[out_format])
+        write_table(df, output_file)
 
+
+def merge(input_dir, output_dir, out_format='csv', tile_index=None, threshold=0.5):
+    # Combine the predicted sub-files of each beam in input_dir into one beam file in output_dir
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
 
+    if tile_index is not None:
+        merge_tiles(input_dir, output_dir, tile_index, out_format, threshold)
+        return
+
     file_list = []
     pattern = r'^(.*[NS])'
     for sub_file in os.listdir(input_dir):
@@ -40,13 +93,13 @@ def main(args):
 
     file_list = set(file_list)
 
-    columns = pd.read_csv(os.path.join(input_dir, os.listdir(input_dir)[0])).columns
+    columns = read_table(os.path.join(input_dir, os.listdir(input_dir)[0])).columns
 
     for file in file_list:
         sub_file_list = []
         for sub_file in os.listdir(input_dir):
             if file in sub_file:
-                df_sub_file = pd.read_csv(os.path.join(input_dir, sub_file), sep=',')
+                df_sub_file = read_table(os.path.join(input_dir, sub_file))
                 sub_file_list.extend(df_sub_file.to_numpy().tolist())
         df = pd.DataFrame(sub_file_list, columns=columns)
         # convert label column to integer
@@ -54,8 +107,15 @@ def main(args):
             df['pred'] = df['pred'].astype(int)
         if 'label' in df.columns:
             df['label'] = df['label'].astype(int)
-        output_file = os.path.join(output_dir, file + '.csv')
-        df.to_csv(output_file, sep=',', index=False, header=True)
+        output_file = os.path.join(output_dir, file + TABLE_FORMATS[out_format])
+        write_table(df, output_file)
+
+
+def main(args):
+    log_dir = args.log_dir
+    input_dir = os.path.join(log_dir, args.data_dir)
+    output_dir = os.path.join(log_dir, args.output_dir)
+    merge(input_dir, output_dir, args.format, args.tile_index, args.threshold)
 
 
 if __name__ == '__main__':
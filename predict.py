@@ -13,6 +13,8 @@ import importlib
 from tqdm import tqdm
 import numpy as np
 from torch.utils.data import Dataset
+from data_utils.shard_io import ShardReader, load_tile
+from data_utils.ShapeNetDataLoader import pc_normalize, pc_denormalize
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = BASE_DIR
@@ -32,64 +34,76 @@ def to_categorical(y, num_classes):
     return new_y.to(y.device)
 
 
-def pc_denormalize(pc, pc_min, pc_max):
-    for i in range(pc.shape[1]):
-        pc[:, i] = (pc[:, i] + 1) / 2 * (pc_max[i] - pc_min[i]) + pc_min[i]
-    return pc
-
-
-def pc_normalize(pc):
-    pc_min = np.empty(3, dtype=np.float64)
-    pc_max = np.empty(3, dtype=np.float64)
-    for i in range(pc.shape[1]):
-        pc_min[i] = min(pc[:, i])
-        pc_max[i] = max(pc[:, i])
-        pc[:, i] = 2 * ((pc[:, i] - pc_min[i]) / (pc_max[i] - pc_min[i])) - 1
-    return pc, pc_min, pc_max
-
-
 class PartNormalDataset(Dataset):
-    def __init__(self, root='./data', npoints=8192, conf_channel=True):
+    def __init__(self, root='./data', npoints=8192, conf_channel=True, packed=False, npy_cache=True):
         self.npoints = npoints
         self.root = root
         self.conf_channel = conf_channel
+        self.packed = packed
+        # .txt tiles are converted to .npy once and memory mapped after that, e.g. when writing the output
+        self.cache_dir = os.path.join(self.root, 'npy_cache') if npy_cache and not packed else None
 
         self.datapath = []
         dir_point = os.path.join(self.root, 'input_data')
-        fns = sorted(os.listdir(dir_point))
-        for fn in fns:
-            if os.path.splitext(os.path.basename(fn))[1] == '.txt':
-                self.datapath.append(os.path.join(dir_point, fn))
+        if self.packed:
+            # tiles packed into a shard by split_data_bulk.py --pack, read with memory mapping
+            self.shard = ShardReader(dir_point, 'predict')
+            self.datapath = self.shard.names()
+            self.tiles = {name: i for i, name in enumerate(self.datapath)}
+        else:
+            fns = sorted(os.listdir(dir_point))
+            for fn in fns:
+                if os.path.splitext(os.path.basename(fn))[1] == '.txt':
+                    self.datapath.append(os.path.join(dir_point, fn))
 
         self.cache = {}
-        self.cache_size = 20000
+        self.cache_size = 0 if self.packed or self.cache_dir else 20000
+        self.bounds = {}
+
+    def read_tile(self, fn):
+        # all columns of a tile, from its .txt file or from the shard it was packed into
+        if self.packed:
+            return self.shard.read(self.tiles[fn])
+        return load_tile(fn, self.cache_dir)
+
+    def tile_bounds(self, fn, point_set):
+        # min/max of x,y,elev of a tile, from the shard index or computed on the first read of the tile
+        if fn not in self.bounds:
+            bounds = self.shard.bounds(self.tiles[fn]) if self.packed else None
+            if bounds is not None:
+                self.bounds[fn] = (bounds[0][0:3], bounds[1][0:3])
+            else:
+                self.bounds[fn] = (point_set[:, 0:3].min(axis=0), point_set[:, 0:3].max(axis=0))
+        return self.bounds[fn]
 
     def __getitem__(self, index):
+        fn = self.datapath[index]
         if index in self.cache:
-            point_set, cls, seg = self.cache[index]
+            point_set, cls = self.cache[index]
         else:
-            fn = self.datapath[index]
             cls = np.array([0]).astype(np.int32)
-            data = np.loadtxt(fn).astype(np.float64)
+            data = self.read_tile(fn)
             if not self.conf_channel:
                 point_set = data[:, [0, 1, 2]]  # use x,y,elev
             else:
                 point_set = data[:, [0, 1, 2, 6]]  # use x,y,elev,signal_conf
                 point_set[:, -1] = point_set[:, -1].astype(np.int32)
 
-            length = len(point_set)
             if len(self.cache) < self.cache_size:
                 self.cache[index] = (point_set, cls)
 
-        point_set_normalized = point_set
-        point_set_normalized[:, 0:3], pc_min, pc_max = pc_normalize(point_set[:, 0:3])
+        length = len(point_set)
+        pc_min, pc_max = self.tile_bounds(fn, point_set)
 
         point_set_normalized_mask = np.full(self.npoints, True, dtype=bool)
         # resample
         if length > self.npoints:
             choice = np.random.choice(length, self.npoints, replace=False)
-            point_set_normalized = point_set_normalized[choice, :]
-        elif length < self.npoints:
+            point_set = point_set[choice, :]
+        # normalized with the bounds of the whole tile, into a new array so the cached tile stays as it is
+        point_set_normalized = np.concatenate((pc_normalize(point_set[:, 0:3], pc_min, pc_max)[0], point_set[:, 3:]),
+                                              axis=1)
+        if length < self.npoints:
             if not self.conf_channel:
                 pad_point = np.ones((self.npoints-length, 3), dtype=np.float32)
             else:
@@ -121,6 +135,7 @@ def parse_args():
     parser.add_argument('--data_root', type=str, required=True, help='data root file')
     parser.add_argument('--output', action='store_false', help='output test results')
     parser.add_argument('--threshold', type=float, default=0.5, help='probability threshold')
+    parser.add_argument('--packed', action='store_true', default=False, help='read the tiles from the packed shard')
 
     return parser.parse_args()
 
@@ -159,7 +174,7 @@ def main(args):
 
     root = args.data_root
 
-    TEST_DATASET = PartNormalDataset(root=root, npoints=args.num_point, conf_channel=args.conf)
+    TEST_DATASET = PartNormalDataset(root=root, npoints=args.num_point, conf_channel=args.conf, packed=args.packed)
     testDataLoader = torch.utils.data.DataLoader(TEST_DATASET, batch_size=args.batch_size, shuffle=False, num_workers=3)
     log_string("The number of test data is: %d" % len(TEST_DATASET))
     num_classes = 1
@@ -228,7 +243,7 @@ def main(args):
                     cur_pc_min = pc_min[i, :]
                     cur_pc_max = pc_max[i, :]
                     # recover other info
-                    data = np.loadtxt(fn[i]).astype(np.float64)
+                    data = TEST_DATASET.read_tile(fn[i])
                     other_data = data[:, [3, 4, 5]]
                     # output points
                     output_points[:, 0:3] = pc_denormalize(output_points[:, 0:3], cur_pc_min, cur_pc_max)
@@ -249,6 +264,10 @@ def main(args):
     out_dir = data_dir + '_merge'
     post_process_command = 'python ' + post_process_script + ' --log_dir ' + str(log_dir) + ' --data_dir ' \
                            + data_dir + ' --output_dir ' + out_dir
+    # sub-files from split_by_npoints come with their photon ranges, so overlapping predictions can be averaged
+    tile_index = os.path.join(root, 'input_data', 'tile_index.csv')
+    if os.path.exists(tile_index):
+        post_process_command += ' --tile_index ' + tile_index + ' --threshold ' + str(args.threshold)
 
     return_code = os.system(post_process_command)
     if return_code != 0:
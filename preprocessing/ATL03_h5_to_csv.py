@@ -14,6 +14,16 @@ import numpy as np
 import scipy.interpolate
 import math
 import argparse
+import concurrent.futures
+import tempfile
+import sys
+import json
+import hashlib
+import threading
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(basedir)
+from data_utils.table_io import TABLE_FORMATS, TableWriter, write_table
 
 
 # Functions
@@ -60,6 +70,57 @@ def findSurface(input, minElev, maxElev):
     return df
 
 
+# ATL03 variables used by the pipeline, per beam group
+ATL03_FIELDS = {
+    'heights': ['delta_time', 'h_ph', 'lat_ph', 'lon_ph', 'signal_conf_ph', 'dist_ph_along'],
+    'geolocation': ['reference_photon_lat', 'reference_photon_lon', 'ph_index_beg', 'segment_ph_cnt',
+                    'segment_dist_x'],
+    'geophys_corr': ['geoid', 'tide_ocean', 'dem_h'],
+}
+
+
+class ATL03Beam:
+    # Lazy reader for a single ATL03 beam (e.g. gt1l). A variable is only read from the HDF5 file the first
+    # time it is asked for, and only the variables listed in fields can be read.
+    def __init__(self, fileID, gtx, fields=ATL03_FIELDS):
+        self.fileID = fileID
+        self.gtx = gtx
+        self.fields = fields
+        self.mds = {}
+
+    def read(self, group, key, start=None, stop=None):
+        # Without start/stop the whole variable is read and cached; a photon range [start, stop) is read on its own
+        if key not in self.fields.get(group, []):
+            raise KeyError('%s/%s is not in the requested ATL03 fields' % (group, key))
+        if group not in self.mds:
+            self.mds[group] = {}
+        if key in self.mds[group]:
+            return self.mds[group][key][start:stop]
+        if start is not None or stop is not None:
+            return self.fileID[self.gtx][group][key][start:stop]
+        self.mds[group][key] = self.fileID[self.gtx][group][key][:]
+        return self.mds[group][key]
+
+    def length(self, group, key):
+        return self.fileID[self.gtx][group][key].shape[0]
+
+    def attributes(self):
+        # -- Global group attributes and the attributes of the requested variables
+        attrs = {}
+        for att_name, att_val in self.fileID[self.gtx].attrs.items():
+            attrs[att_name] = att_val
+        for group, keys in self.fields.items():
+            attrs[group] = {}
+            for key in keys:
+                attrs[group][key] = {}
+                for att_name, att_val in self.fileID[self.gtx][group][key].attrs.items():
+                    attrs[group][key][att_name] = att_val
+        return attrs
+
+    def clear(self):
+        self.mds = {}
+
+
 # setting
 parser = argparse.ArgumentParser(description='Convert ATL03 to CSV file')
 parser.add_argument('--data_dir', type=str, required=True, help='Input directory')
@@ -68,227 +129,734 @@ parser.add_argument('--minElev', type=int, default=-50, help='Minimum elevation
 parser.add_argument('--removeLand', action='store_true')
 parser.add_argument('--removeIrrelevant', action='store_true')
 parser.add_argument('--utm', action='store_true')
-parser.add_argument('--interval', default=100000)
+parser.add_argument('--interval', type=int, default=100000)
+parser.add_argument('--readAttributes', action='store_true', help='Also harvest the HDF5 attributes of the beam variables')
+parser.add_argument('--chunkSize', type=int, default=None,
+                    help='Stream each beam in chunks of about this many photons instead of reading it whole')
+parser.add_argument('--corrections', type=str, default='segment', choices=['segment', 'interp'],
+                    help='Take geoid, tide and DEM heights from the geolocation segment of each photon, '
+                         'or interpolate them on latitude')
+parser.add_argument('--surface', type=str, default='vectorized', choices=['vectorized', 'loop'],
+                    help='Find the water surface of all windows in a single pass, or with the original window loop')
+parser.add_argument('--surfaceReport', action='store_true',
+                    help='Write the water surface elevation of each window to csv_data/surface')
+parser.add_argument('--format', type=str, default='csv', choices=list(TABLE_FORMATS),
+                    help='Output format of the beam files; parquet and feather need pyarrow')
+parser.add_argument('--force', action='store_true',
+                    help='Convert all granules, also those the manifest records as already converted')
+parser.add_argument('--alongTrack', action='store_true',
+                    help='Add the along-track distance of each photon (segment_dist_x + dist_ph_along) as dist_along')
+parser.add_argument('--projectionThreads', type=int, default=1, help='Number of threads projecting large beams to UTM')
+parser.add_argument('--bbox', type=float, nargs=4, default=None, metavar=('MINLON', 'MINLAT', 'MAXLON', 'MAXLAT'),
+                    help='Only convert the photons within this bounding box (degrees)')
+parser.add_argument('--latRange', '--lat-range', type=float, nargs=2, default=None, metavar=('MINLAT', 'MAXLAT'),
+                    help='Only convert the photons within this latitude range (degrees)')
+parser.add_argument('--workers', type=int, default=1, help='Number of processes converting (granule, beam) pairs in parallel')
+
+
+def listBeams(fileID):
+    # -- find each input beam within the file
+    IS2_atl03_beams = []
+    for gtx in [k for k in fileID.keys() if bool(re.match(r'gt\d[lr]', k))]:
+        try:
+            fileID[gtx]['geolocation']['reference_photon_lat']
+            fileID[gtx]['heights']['delta_time']
+        except KeyError:
+            pass
+        else:
+            IS2_atl03_beams.append(gtx)
+    return IS2_atl03_beams
+
+
+def referenceFrame(beam):
+    # Put reference information in pandas df
+
+    df_ref = pd.DataFrame()
+    df_ref['ref_lat'] = beam.read('geolocation', 'reference_photon_lat')
+    df_ref['ref_lon'] = beam.read('geolocation', 'reference_photon_lon')
+    df_ref['ref_geoid'] = beam.read('geophys_corr', 'geoid')
+    df_ref['ref_tide'] = beam.read('geophys_corr', 'tide_ocean')
+    df_ref['ref_dem'] = beam.read('geophys_corr', 'dem_h')
+
+    # Remove NAs
+    df_ref = df_ref[df_ref['ref_geoid'] < 90]
+    df_ref = df_ref[df_ref['ref_geoid'] > -105]
+
+    return df_ref
+
+
+def photonSegments(ph_index_beg, segment_ph_cnt, start, stop):
+    # Index of the geolocation segment each photon in [start, stop) belongs to, -1 for photons without a segment
+    valid = np.nonzero(segment_ph_cnt > 0)[0]
+    first = ph_index_beg[valid] - 1  # ph_index_beg is 1-based
+    lo = max(np.searchsorted(first, start, side='right') - 1, 0)
+    hi = np.searchsorted(first, stop, side='left')
+    seg, first, count = valid[lo:hi], first[lo:hi], segment_ph_cnt[valid[lo:hi]].astype(np.int64)
+
+    # Expand every segment onto its photons
+    pos = np.repeat(first - start, count) + np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+    seg = np.repeat(seg, count)
+    inside = (pos >= 0) & (pos < stop - start)
+    idx = np.full(stop - start, -1, dtype=np.int64)
+    idx[pos[inside]] = seg[inside]
+    return idx
+
+
+def regionOfInterest(bbox=None, latRange=None):
+    # Combine --bbox and --latRange into a single (minLon, minLat, maxLon, maxLat) box, None if neither is given
+    if bbox is None and latRange is None:
+        return None
+    region = list(bbox) if bbox is not None else [-180.0, -90.0, 180.0, 90.0]
+    if latRange is not None:
+        region[1] = max(region[1], latRange[0])
+        region[3] = min(region[3], latRange[1])
+    return region
+
+
+def inRegion(lon, lat, region):
+    return (lon >= region[0]) & (lon <= region[2]) & (lat >= region[1]) & (lat <= region[3])
+
+
+def regionPhotons(beam, region):
+    # Photon range [start, stop) covering the geolocation segments whose reference photon lies in the region, plus one
+    # segment on either side as the reference photon is somewhere inside its 20 m segment. Only the small geolocation
+    # arrays are read; (None, None) if no segment is in the region
+    ph_index_beg = beam.read('geolocation', 'ph_index_beg')
+    segment_ph_cnt = beam.read('geolocation', 'segment_ph_cnt')
+    inside = inRegion(beam.read('geolocation', 'reference_photon_lon'),
+                      beam.read('geolocation', 'reference_photon_lat'), region)
+    segments = np.nonzero(inside)[0]
+    if len(segments) == 0:
+        return None, None
+    valid = np.nonzero(segment_ph_cnt > 0)[0]
+    lo = max(np.searchsorted(valid, segments[0], side='left') - 1, 0)
+    hi = min(np.searchsorted(valid, segments[-1], side='right'), len(valid) - 1)
+    if lo > hi:
+        return None, None
+    start = int(ph_index_beg[valid[lo]]) - 1  # ph_index_beg is 1-based
+    stop = int(ph_index_beg[valid[hi]]) - 1 + int(segment_ph_cnt[valid[hi]])
+    return start, stop
+
+
+def correctionLookup(beam, df_ref, corrections='segment'):
+    # Geoid, tide and DEM heights per geolocation segment (NaN for segments removed from df_ref), or a single
+    # interpolator of the three on reference photon latitude
+    if corrections == 'interp':
+        return scipy.interpolate.interp1d(df_ref['ref_lat'].to_numpy(),
+                                          df_ref[['ref_geoid', 'ref_tide', 'ref_dem']].to_numpy(), axis=0)
+    lookup = np.full((beam.length('geolocation', 'ph_index_beg'), 3), np.nan)
+    lookup[df_ref.index.to_numpy()] = df_ref[['ref_geoid', 'ref_tide', 'ref_dem']].to_numpy()
+    return lookup
+
+
+def correctedPhotons(beam, df_ref, lookup, start=None, stop=None, corrections='segment', alongTrack=False,
+                     region=None):
+    # Read photons [start, stop) of a beam, filter them and apply the geophysical corrections
+
+    # Put data in pandas df
+    df_data = pd.DataFrame()
+    df_data['delta_time'] = beam.read('heights', 'delta_time', start, stop)
+    df_data['h_ph'] = beam.read('heights', 'h_ph', start, stop)
+    df_data['lat_ph'] = beam.read('heights', 'lat_ph', start, stop)
+    df_data['lon_ph'] = beam.read('heights', 'lon_ph', start, stop)
+
+    # This finds the maximum confidence value of any category
+    df_data['signal_conf_ph'] = np.amax(beam.read('heights', 'signal_conf_ph', start, stop), axis=1)
+
+    if region is not None:
+        # Remove data outside the region of interest
+        df_data = df_data[inRegion(df_data['lon_ph'], df_data['lat_ph'], region)]
+
+    if corrections == 'interp':
+        # Remove data outside reference scope
+        df_data = df_data[df_data['lat_ph'] > df_ref['ref_lat'].min()]
+        df_data = df_data[df_data['lat_ph'] < df_ref['ref_lat'].max()]
+
+    # Remove data with low confidence - 3 is medium confidence, 4 is high confidence
+    df_data = df_data[df_data['signal_conf_ph'] >= 3]
+
+    if corrections == 'segment' or alongTrack:
+        # 20 m geolocation segment of each photon
+        if start is None:
+            start, stop = 0, beam.length('heights', 'h_ph')
+        seg = photonSegments(beam.read('geolocation', 'ph_index_beg'), beam.read('geolocation', 'segment_ph_cnt'),
+                             start, stop)[df_data.index.to_numpy()]
+
+    if alongTrack:
+        # Along-track distance from the start of the reference ground track: segment start plus photon offset in it
+        dist_ph_along = beam.read('heights', 'dist_ph_along', start, stop)[df_data.index.to_numpy()]
+        df_data['dist_along'] = np.where(seg >= 0, beam.read('geolocation', 'segment_dist_x')[seg] + dist_ph_along,
+                                         np.nan)
+
+    if corrections == 'interp':
+        # Interpolate geoid, tide and DEM heights to photon latitudes
+        values = lookup(df_data['lat_ph'])
+    else:
+        # Take geoid, tide and DEM heights from the geolocation segment of each photon
+        values = np.full((len(df_data), 3), np.nan)
+        values[seg >= 0] = lookup[seg[seg >= 0]]
+        # Remove photons without (valid) reference information
+        keep = ~np.isnan(values[:, 0])
+        df_data = df_data[keep]
+        values = values[keep]
+    df_data['geoid'] = values[:, 0]
+    df_data['tide'] = values[:, 1]
+    df_data['dem'] = values[:, 2]
+
+    # Not applying tide here, because we want the location relative to the geoid (msl)
+    df_data['elev'] = df_data['h_ph'] - df_data['geoid']
+
+    # Remove data outside reasonable boundaries
+    df_data = df_data[df_data['elev'] > -12000]
+    df_data = df_data[df_data['lat_ph'] < 9000]
+
+    return df_data
+
+
+def utmZone(lon, lat):
+    # Find UTM zone to reproject to from the mean photon location
+    zoneToUse = math.ceil((lon + 180) / 6)
+    if lat > 0:
+        outEPSG = str(326) + str(zoneToUse)
+        zone = str(zoneToUse) + "N"
+    else:
+        outEPSG = str(327) + str(zoneToUse)
+        zone = str(zoneToUse) + "S"
+    return outEPSG, zone
+
+
+# Transformers from WGS84 by output EPSG code. pyproj transformers shouldn't be shared between threads, so every thread
+# keeps its own cache
+transformers = threading.local()
+
+
+def getTransformer(outEPSG):
+    if not hasattr(transformers, 'cache'):
+        transformers.cache = {}
+    if outEPSG not in transformers.cache:
+        transformers.cache[outEPSG] = Transformer.from_crs("epsg:4326", "epsg:" + outEPSG)
+    return transformers.cache[outEPSG]
+
+
+def projectPhotons(lat, lon, outEPSG, threads=1, chunkSize=1000000):
+    # Project photon locations to outEPSG. Large beams are projected in chunks on a thread pool; PROJ releases the GIL
+    # and every point is transformed on its own, so the result doesn't depend on the number of threads
+    if threads <= 1 or len(lat) <= chunkSize:
+        return getTransformer(outEPSG).transform(lat, lon)
+    bounds = range(0, len(lat), chunkSize)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        parts = list(executor.map(lambda i: getTransformer(outEPSG).transform(lat[i:i + chunkSize],
+                                                                               lon[i:i + chunkSize]), bounds))
+    return np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts])
+
+
+def formatPhotons(df_data, outEPSG=None, removeLand=True, removeIrrelevant=True, maxElev=10, minElev=-50,
+                  projectionThreads=1):
+    # Project the corrected photons (if outEPSG is given), filter them and put the output columns in order
+    utm = outEPSG is not None
+
+    if utm:
+        df_data["x"], df_data["y"] = projectPhotons(df_data["lat_ph"].to_numpy(), df_data["lon_ph"].to_numpy(),
+                                                    outEPSG, threads=projectionThreads)
+
+    # Remove irrelevant photons (deeper than 50m, higher than 20m)
+    if removeIrrelevant:
+        df_data = df_data[(df_data["elev"] > minElev) & (df_data["elev"] < maxElev)]
+
+    if removeLand:  # Remove photons for which the DEM is more than 50m above the geoid
+        df_data = df_data[(df_data["dem"] - df_data["geoid"] < 50)]
+
+    # Remove unwanted columns
+    df = df_data.drop(['delta_time', 'h_ph', 'geoid', 'dem'], axis=1)
+
+    # Add class column
+    df['class'] = np.full((len(df)), 3)
 
+    # Set nodata to 0 for tides (slightly dangerous)
+    tides = np.array(df['tide'].values.tolist())
+    df['tide'] = np.where(tides > 1000, 0, tides).tolist()
 
-def convert(dataDir, utm=True, removeLand=True, removeIrrelevant=True, interval=100000, maxElev=10, minElev=-50):
+    if utm:
+        df['lat'] = df['lat_ph']  # Keeping lat and lon here for reference
+        df['lon'] = df['lon_ph']
+        df = df.drop(['lat_ph', 'lon_ph'], axis=1)
+        df = df[['x', 'y', 'lon', 'lat', 'elev', 'tide', 'signal_conf_ph',
+                 'class']]  # Change the order of the columns
+    else:
+        df['lat'] = df['lat_ph']
+        df['lon'] = df['lon_ph']
+        df = df.drop(['lat_ph', 'lon_ph'], axis=1)
+        df = df[
+            ['lon', 'lat', 'elev', 'tide', 'signal_conf_ph', 'class']]  # Change the order of the columns
+
+    if 'dist_along' in df_data.columns:
+        # Along-track distance goes last, so the other columns keep their positions
+        df['dist_along'] = df_data['dist_along']
+
+    # Do normalization so all values are between 0 and 1
+    # df = (df - df.min()) / (df.max() - df.min())
+
+    # Round to three decimals for all variables
+    # df = df.round(decimals=3)
+
+    return df
+
+
+def outputFilename(output_dir, filename, gtx, zone=None, outFormat='csv'):
+    if zone is not None:
+        outFilename = output_dir + "/" + os.path.basename(filename)[
+                                  :-3] + "_" + gtx + "_raw_" + zone + TABLE_FORMATS[outFormat]  # Reinstate if
+    else:
+        outFilename = output_dir + "/" + os.path.basename(filename)[:-3] + "_" + gtx + "_raw" + TABLE_FORMATS[outFormat]
+    return outFilename
+
+
+def segmentChunks(ph_index_beg, segment_ph_cnt, nPhotons, chunkSize, first=0):
+    # Split the photons [first, nPhotons) of a beam into ranges [start, stop) of at most chunkSize photons (unless a
+    # single geolocation segment is larger) that begin on the first photon of a segment, so no segment is split between
+    # two chunks. first has to be the first photon of a segment
+    starts = ph_index_beg[segment_ph_cnt > 0] - 1  # ph_index_beg is 1-based
+    chunks = []
+    start = first
+    while start < nPhotons:
+        if start + chunkSize >= nPhotons:
+            stop = nPhotons
+        else:
+            i = np.searchsorted(starts, start + chunkSize, side='right') - 1
+            if i >= 0 and starts[i] > start:
+                stop = starts[i]
+            else:
+                j = np.searchsorted(starts, start, side='right')
+                stop = starts[j] if j < len(starts) else nPhotons
+        chunks.append((start, int(stop)))
+        start = int(stop)
+    return chunks
+
+
+def surfaceWindows(yMin, yMax, interval):
+    # Edges of the along-track windows the water surface is searched in, stepped exactly like the findSurface loop
+    num = math.ceil((yMax - yMin) / interval)
+    edges = [yMin]
+    for i in range(num):
+        edges.append(edges[-1] + interval)
+    return np.array(edges)
+
+
+def windowIndex(y, windowEdges):
+    # Window of each photon, -1 for photons beyond the last window
+    w = np.searchsorted(windowEdges, y, side='right') - 1
+    w[w >= len(windowEdges) - 1] = -1
+    return w
+
+
+def windowHistogram(elev, w, bins):
+    # np.histogram of the photons of every window at once. bins holds the bin edges of each window (one row per window),
+    # and bin indices are computed the way numpy does for equal-width bins, so the counts are the same as per window
+    nwindows, nbins = bins.shape[0], bins.shape[1] - 1
+    flat = bins.ravel()
+    row = w * (nbins + 1)
+    first, last = flat[row], flat[row + nbins]
+    indices = ((elev - first) / (last - first) * nbins).astype(np.intp)
+    indices[indices == nbins] -= 1
+    decrement = elev < flat[row + indices]
+    indices[decrement] -= 1
+    increment = (elev >= flat[row + indices + 1]) & (indices != nbins - 1)
+    indices[increment] += 1
+    return np.bincount(w * nbins + indices, minlength=nwindows * nbins).reshape(nwindows, nbins)
+
+
+def surfaceStatistics(batches, nwindows, minElev, maxElev):
+    # Water surface of each window as found by findSurface: the mean and sd of the photons within +/- 2 bins of the
+    # largest elevation histogram bin. batches() yields (elev, window) arrays of photons; passing the photons in several
+    # batches gives the same result, so a beam can also be processed one chunk at a time
+    nbins = int(maxElev - minElev)
+
+    # Elevation range of each window, which sets its histogram bins
+    lo = np.full(nwindows, np.inf)
+    hi = np.full(nwindows, -np.inf)
+    photons = np.zeros(nwindows, dtype=np.int64)
+    for elev, w in batches():
+        np.minimum.at(lo, w, elev)
+        np.maximum.at(hi, w, elev)
+        photons += np.bincount(w, minlength=nwindows)
+    bins = np.zeros((nwindows, nbins + 1))
+    for k in np.nonzero(photons)[0]:
+        bins[k] = np.histogram_bin_edges(np.array([lo[k], hi[k]]), nbins)
+
+    # Histogram of each window
+    hist = np.zeros((nwindows, nbins), dtype=np.int64)
+    for elev, w in batches():
+        hist += windowHistogram(elev, w, bins)
+
+    # Get subset of histogram, +/- 2m around the largest bin
+    largest_bin = np.argmax(hist, axis=1)
+    if np.any(largest_bin[photons > 0] == 0):
+        print("Weird depth distribution of points, check visually")
+    lower = bins[np.arange(nwindows), np.maximum(largest_bin - 2, 0)]
+    upper = bins[np.arange(nwindows), np.minimum(largest_bin + 2, nbins)]
+
+    # Mean and standard deviation of the photons around the largest bin
+    total = np.zeros(nwindows)
+    count = np.zeros(nwindows, dtype=np.int64)
+    for elev, w in batches():
+        subset = (elev > lower[w]) & (elev < upper[w])
+        total += np.bincount(w[subset], weights=elev[subset], minlength=nwindows)
+        count += np.bincount(w[subset], minlength=nwindows)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+    squares = np.zeros(nwindows)
+    for elev, w in batches():
+        subset = (elev > lower[w]) & (elev < upper[w])
+        squares += np.bincount(w[subset], weights=(elev[subset] - mean[w[subset]]) ** 2, minlength=nwindows)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sd = np.sqrt(squares / count)
+
+    return pd.DataFrame({'photons': photons, 'surface_photons': count, 'surface_elev': mean, 'surface_sd': sd})
+
+
+def surfaceReport(windowEdges, surface):
+    # Per window summary of the water surface, written next to the beam csv files
+    report = surface.copy()
+    report.insert(0, 'y_end', windowEdges[1:])
+    report.insert(0, 'y_start', windowEdges[:-1])
+    report.insert(0, 'window', np.arange(len(report)))
+    return report
+
+
+def labelSurface(df, w, surface):
+    # set water surface as 5
+    mean = surface['surface_elev'].to_numpy()[w]
+    sd = surface['surface_sd'].to_numpy()[w]
+    elev = df['elev'].to_numpy()
+    df.loc[(elev > mean - 2 * sd) & (elev < mean + 2 * sd), 'class'] = 5
+    # only keep the points that are lower than average water surface level to decrease data volume
+    return df[elev < mean]
+
+
+def findSurfaceWindows(df, interval, minElev, maxElev):
+    # Single pass version of the findSurface loop: all photons are binned into their windows at once and labelled in
+    # bulk. Gives the same photons in the same (window) order as the loop, plus the water surface of each window
+    windowEdges = surfaceWindows(df['y'].min(), df['y'].max(), interval)
+    w = windowIndex(df['y'].to_numpy(), windowEdges)
+    elev = df['elev'].to_numpy()
+    surface = surfaceStatistics(lambda: [(elev[w >= 0], w[w >= 0])], len(windowEdges) - 1, minElev, maxElev)
+
+    order = np.nonzero(w >= 0)[0]
+    order = order[np.argsort(w[order], kind='stable')]
+    df = df.iloc[order].reset_index(drop=True)
+    df = labelSurface(df, w[order], surface)
+    return df.reset_index(drop=True), surfaceReport(windowEdges, surface)
+
+
+def writeSurfaceReport(outFilename, report):
+    report_dir = os.path.join(os.path.dirname(outFilename), 'surface')
+    os.makedirs(report_dir, exist_ok=True)
+    report_file = os.path.join(report_dir, os.path.splitext(os.path.basename(outFilename))[0] + '_surface.csv')
+    report.to_csv(report_file, index=False)
+
+
+def convertBeamStreaming(beam, df_ref, output_dir, tmp_dir, utm=True, removeLand=True, removeIrrelevant=True,
+                         interval=100000, maxElev=10, minElev=-50, chunkSize=1000000, corrections='segment',
+                         report=False, outFormat='csv', alongTrack=False, projectionThreads=1, region=None,
+                         photons=None):
+    # Convert a beam in chunks of geolocation segments. Every chunk is spilled to tmp_dir after each step, so peak memory
+    # depends on chunkSize rather than on the number of photons in the beam. photons limits the conversion to a photon
+    # range [start, stop) that starts on a segment
+    first, nPhotons = photons if photons is not None else (0, beam.length('heights', 'h_ph'))
+    chunks = segmentChunks(beam.read('geolocation', 'ph_index_beg'), beam.read('geolocation', 'segment_ph_cnt'),
+                           nPhotons, chunkSize, first)
+
+    # Read and correct each chunk, keeping track of the mean location for the UTM zone
+    spills = []
+    lon_sum, lat_sum, n = 0.0, 0.0, 0
+    lookup = correctionLookup(beam, df_ref, corrections)
+    for i, (start, stop) in enumerate(chunks):
+        df_data = correctedPhotons(beam, df_ref, lookup, start, stop, corrections=corrections, alongTrack=alongTrack,
+                                   region=region)
+        lon_sum += df_data['lon_ph'].sum()
+        lat_sum += df_data['lat_ph'].sum()
+        n += len(df_data)
+        spill = os.path.join(tmp_dir, 'chunk_%06d.pkl' % i)
+        df_data.to_pickle(spill)
+        spills.append(spill)
+    if n == 0:
+        return None, None
+
+    outEPSG, zone = None, None
+    if utm:
+        outEPSG, zone = utmZone(lon_sum / n, lat_sum / n)
+    outFilename = outputFilename(output_dir, beam.fileID.filename, beam.gtx, zone, outFormat)
+
+    # Project and filter each chunk
+    yMin, yMax = np.inf, -np.inf
+    for spill in spills:
+        df = formatPhotons(pd.read_pickle(spill), outEPSG=outEPSG, removeLand=removeLand,
+                           removeIrrelevant=removeIrrelevant, maxElev=maxElev, minElev=minElev,
+                           projectionThreads=projectionThreads)
+        if not df.empty:
+            yMin = min(yMin, df['y'].min())
+            yMax = max(yMax, df['y'].max())
+        df.to_pickle(spill)
+        template = df.iloc[:0]
+
+    # The writer puts out the header/schema first, so that a beam without any remaining photons still gives a valid file
+    writer = TableWriter(outFilename, template)
+    if yMin > yMax:
+        writer.close()
+        return outFilename, zone
+
+    # Find water surface
+    windowEdges = surfaceWindows(yMin, yMax, interval)
+
+    def batches():
+        for spill in spills:
+            df = pd.read_pickle(spill)
+            w = windowIndex(df['y'].to_numpy(), windowEdges)
+            yield df['elev'].to_numpy()[w >= 0], w[w >= 0]
+
+    surface = surfaceStatistics(batches, len(windowEdges) - 1, minElev, maxElev)
+
+    # Label the surface of each chunk in a single pass and bucket its photons into blocks of consecutive windows of
+    # about chunkSize photons. Every spill is read once, and every block is read once to write its photons in window
+    # order, as findSurface does
+    photons = surface['photons'].to_numpy()
+    windowBlock = (np.cumsum(photons) - photons) // chunkSize
+    blocks = [[] for _ in range(int(windowBlock.max(initial=-1)) + 1)]
+    for i, spill in enumerate(spills):
+        df = pd.read_pickle(spill)
+        os.remove(spill)
+        w = windowIndex(df['y'].to_numpy(), windowEdges)
+        order = np.nonzero(w >= 0)[0]
+        order = order[np.argsort(w[order], kind='stable')]
+        df = labelSurface(df.iloc[order].reset_index(drop=True), w[order], surface)
+        b = windowBlock[w[order][df.index.to_numpy()]]
+        starts = np.flatnonzero(np.diff(b, prepend=-1))
+        for start, stop in zip(starts, np.append(starts[1:], len(b))):
+            piece = os.path.join(tmp_dir, 'block_%06d_%06d.pkl' % (b[start], i))
+            df.iloc[start:stop].to_pickle(piece)
+            blocks[b[start]].append(piece)
+    for pieces in blocks:
+        if not pieces:
+            continue
+        # the pieces are in chunk order, so a stable sort by window gives the photons of each window in beam order
+        df = pd.concat([pd.read_pickle(piece) for piece in pieces], ignore_index=True)
+        w = windowIndex(df['y'].to_numpy(), windowEdges)
+        writer.write(df.iloc[np.argsort(w, kind='stable')])
+    writer.close()
+
+    if report:
+        writeSurfaceReport(outFilename, surfaceReport(windowEdges, surface))
+
+    return outFilename, zone
+
+
+def convertBeam(fileID, gtx, output_dir, utm=True, removeLand=True, removeIrrelevant=True, interval=100000, maxElev=10,
+                minElev=-50, readAttributes=False, chunkSize=None, corrections='segment', surface='vectorized',
+                report=False, outFormat='csv', alongTrack=False, projectionThreads=1, region=None):
+    # Convert a single beam of an open ATL03 file and write it to its own csv file. With a region of interest only the
+    # photons of the geolocation segments in the region are read; the output filename is None if there are none
+    filename = fileID.filename
+
+    # -- variables are only read from the file when the pipeline asks for them
+    beam = ATL03Beam(fileID, gtx)
+    IS2_atl03_attrs = beam.attributes() if readAttributes else None
+
+    start, stop = None, None
+    if region is not None:
+        start, stop = regionPhotons(beam, region)
+        if start is None:
+            print('No photons of %s in the region of interest' % gtx)
+            return None, IS2_atl03_attrs
+
+    df_ref = referenceFrame(beam)
+
+    if chunkSize:
+        with tempfile.TemporaryDirectory(dir=output_dir) as tmp_dir:
+            outFilename, zone = convertBeamStreaming(beam, df_ref, output_dir, tmp_dir, utm=utm, removeLand=removeLand,
+                                                     removeIrrelevant=removeIrrelevant, interval=interval,
+                                                     maxElev=maxElev, minElev=minElev, chunkSize=chunkSize,
+                                                     corrections=corrections, report=report, outFormat=outFormat,
+                                                     alongTrack=alongTrack, projectionThreads=projectionThreads,
+                                                     region=region, photons=(start, stop) if region else None)
+        if outFilename is None:
+            print('No photons of %s in the region of interest' % gtx)
+        return outFilename, IS2_atl03_attrs
+
+    df_data = correctedPhotons(beam, df_ref, correctionLookup(beam, df_ref, corrections), start, stop,
+                               corrections=corrections, alongTrack=alongTrack, region=region)
+    if region is not None and df_data.empty:
+        print('No photons of %s in the region of interest' % gtx)
+        return None, IS2_atl03_attrs
+
+    outEPSG, zone = None, None
+    if utm:
+        outEPSG, zone = utmZone(df_data["lon_ph"].mean(), df_data["lat_ph"].mean())
+
+    df = formatPhotons(df_data, outEPSG=outEPSG, removeLand=removeLand, removeIrrelevant=removeIrrelevant,
+                       maxElev=maxElev, minElev=minElev, projectionThreads=projectionThreads)
+
+    outFilename = outputFilename(output_dir, filename, gtx, zone, outFormat)
+
+    # Find water surface
+    if surface == 'loop':
+        # Original window by window search, kept to check the single pass version against
+        df_segment_all = pd.DataFrame(columns=df.columns)
+        num = math.ceil((df['y'].max() - df['y'].min()) / interval)
+        y1 = df['y'].min()
+        for i in range(num):
+            y2 = y1 + interval
+            df_segment = df[(df['y'] >= y1) & (df['y'] < y2)].copy()
+            if not df_segment.empty:
+                df_segment = findSurface(df_segment, minElev, maxElev)
+            df_segment_all = pd.concat([df_segment_all, df_segment], ignore_index=True)
+            y1 = y2
+        df = df_segment_all
+    elif not df.empty:
+        df, df_report = findSurfaceWindows(df, interval, minElev, maxElev)
+        if report:
+            writeSurfaceReport(outFilename, df_report)
+
+    # Write data to csv (or Parquet/Feather) file
+    write_table(df, outFilename)
+
+    return outFilename, IS2_atl03_attrs
+
+
+def convertBeamJob(filename, gtx, output_dir, kwargs):
+    # Process pool entry point: h5py file handles can't be shared between processes, so each job opens the file itself
+    with h5py.File(filename, mode='r') as fileID:
+        return convertBeam(fileID, gtx, output_dir, **kwargs)
+
+
+def fileHash(filename, blockSize=1 << 20):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def loadManifest(output_dir):
+    # Record of the converted granules: source size/mtime/hash, conversion parameters and the beam files produced
+    manifest_file = os.path.join(output_dir, 'manifest.json')
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+
+def saveManifest(output_dir, manifest):
+    # Write to a temporary file first so that an interrupted run can't leave a broken manifest behind
+    manifest_file = os.path.join(output_dir, 'manifest.json')
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def isUpToDate(entry, filename, output_dir, params):
+    # A granule is up to date if it was converted with the same parameters, all its beam files still exist and the
+    # source is unchanged. The hash is only computed when size matches but mtime doesn't (e.g. after a copy)
+    if entry is None or entry['params'] != params:
+        return False
+    if not all(os.path.exists(os.path.join(output_dir, output)) for output in entry['outputs']):
+        return False
+    stat = os.stat(filename)
+    if stat.st_size != entry['size']:
+        return False
+    if stat.st_mtime != entry['mtime']:
+        if fileHash(filename) != entry['sha256']:
+            return False
+        entry['mtime'] = stat.st_mtime
+    return True
+
+
+def manifestEntry(filename, output_dir, params, outFilenames, entry=None):
+    # Beam files of an earlier conversion that this one didn't produce again are removed
+    outputs = sorted(os.path.basename(outFilename) for outFilename in outFilenames)
+    if entry is not None:
+        for output in set(entry['outputs']) - set(outputs):
+            deleteFileIfExists(os.path.join(output_dir, output))
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': fileHash(filename), 'params': params,
+            'outputs': outputs}
+
+
+def convert(dataDir, utm=True, removeLand=True, removeIrrelevant=True, interval=100000, maxElev=10, minElev=-50,
+            readAttributes=False, workers=1, chunkSize=None, corrections='segment', surface='vectorized', report=False,
+            outFormat='csv', force=False, alongTrack=False, projectionThreads=1, bbox=None, latRange=None):
     filenames = glob.glob(dataDir + "/*.h5")
 
     output_dir = os.path.join(dataDir, 'csv_data')
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
 
+    kwargs = dict(utm=utm, removeLand=removeLand, removeIrrelevant=removeIrrelevant, interval=interval, maxElev=maxElev,
+                  minElev=minElev, readAttributes=readAttributes, chunkSize=chunkSize, corrections=corrections,
+                  surface=surface, report=report, outFormat=outFormat, alongTrack=alongTrack,
+                  projectionThreads=projectionThreads, region=regionOfInterest(bbox, latRange))
+
+    # Only granules that are new, changed or converted with other parameters are converted again
+    params = dict(utm=utm, removeLand=removeLand, removeIrrelevant=removeIrrelevant, interval=interval, maxElev=maxElev,
+                  minElev=minElev, corrections=corrections, outFormat=outFormat, alongTrack=alongTrack,
+                  region=regionOfInterest(bbox, latRange))
+    manifest = loadManifest(output_dir)
+    todo = []
     for filename in filenames:
+        entry = manifest.get(os.path.basename(filename))
+        if not force and isUpToDate(entry, filename, output_dir, params):
+            print('Skipping %s, already converted' % os.path.basename(filename))
+        else:
+            todo.append(filename)
+    saveManifest(output_dir, manifest)
+
+    # -- ICESat-2 ATL03 attributes by file and beam (only filled if requested)
+    IS2_atl03_attrs = {}
+
+    if workers > 1:
+        # Every (granule, beam) pair is written to its own file, so the jobs are independent of each other
+        jobs = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for filename in todo:
+                print('Start converting H5 to CSV...')
+                with h5py.File(filename, mode='r') as fileID:
+                    IS2_atl03_beams = listBeams(fileID)
+                for gtx in IS2_atl03_beams:
+                    jobs.append((filename, gtx, executor.submit(convertBeamJob, filename, gtx, output_dir, kwargs)))
+            outFilenames = {filename: [] for filename in todo}
+            for filename, gtx, job in jobs:
+                outFilename, attrs = job.result()
+                if outFilename is not None:
+                    outFilenames[filename].append(outFilename)
+                if readAttributes:
+                    IS2_atl03_attrs.setdefault(filename, {})[gtx] = attrs
+        for filename in todo:
+            basename = os.path.basename(filename)
+            manifest[basename] = manifestEntry(filename, output_dir, params, outFilenames[filename],
+                                               manifest.get(basename))
+        saveManifest(output_dir, manifest)
+        return IS2_atl03_attrs
+
+    for filename in todo:
 
         # print(filename)
         print('Start converting H5 to CSV...')
 
+        outFilenames = []
         with h5py.File(filename, mode='r') as fileID:
             # List all groups
             # print("Keys: %s" % fileID.keys())
 
-            # -- allocate python dictionaries for ICESat-2 ATL03 variables and attributes
-            IS2_atl03_mds = {}
-            IS2_atl03_attrs = {}
-
-            # -- read each input beam within the file
-            IS2_atl03_beams = []
-            for gtx in [k for k in fileID.keys() if bool(re.match(r'gt\d[lr]', k))]:
-                try:
-                    fileID[gtx]['geolocation']['reference_photon_lat']
-                    fileID[gtx]['heights']['delta_time']
-                except KeyError:
-                    pass
-                else:
-                    IS2_atl03_beams.append(gtx)
-
-                # -- for each included beam
-            for gtx in IS2_atl03_beams:
-                # -- get each HDF5 variable
-                IS2_atl03_mds[gtx] = {}
-                IS2_atl03_mds[gtx]['heights'] = {}
-                IS2_atl03_mds[gtx]['geolocation'] = {}
-                # IS2_atl03_mds[gtx]['bckgrd_atlas'] = {}
-                IS2_atl03_mds[gtx]['geophys_corr'] = {}
-                # -- ICESat-2 Measurement Group
-                for key, val in fileID[gtx]['heights'].items():
-                    IS2_atl03_mds[gtx]['heights'][key] = val[:]
-                # -- ICESat-2 Geolocation Group
-                for key, val in fileID[gtx]['geolocation'].items():
-                    IS2_atl03_mds[gtx]['geolocation'][key] = val[:]
-                # -- ICESat-2 Background Photon Rate Group
-                # for key, val in fileID[gtx]['bckgrd_atlas'].items():
-                #     IS2_atl03_mds[gtx]['bckgrd_atlas'][key] = val[:]
-                # -- ICESat-2 Geophysical Corrections Group: Values for tides (ocean,
-                # -- solid earth, pole, load, and equilibrium), inverted barometer (IB)
-                # -- effects, and range corrections for tropospheric delays
-                for key, val in fileID[gtx]['geophys_corr'].items():
-                    IS2_atl03_mds[gtx]['geophys_corr'][key] = val[:]
-
-                # -- Getting attributes of IS2_atl03_mds beam variables
-                IS2_atl03_attrs[gtx] = {}
-                IS2_atl03_attrs[gtx]['heights'] = {}
-                IS2_atl03_attrs[gtx]['geolocation'] = {}
-                # IS2_atl03_attrs[gtx]['bckgrd_atlas'] = {}
-                IS2_atl03_attrs[gtx]['geophys_corr'] = {}
-                # -- Global Group Attributes
-                for att_name, att_val in fileID[gtx].attrs.items():
-                    IS2_atl03_attrs[gtx][att_name] = att_val
-                # -- ICESat-2 Measurement Group
-                for key, val in fileID[gtx]['heights'].items():
-                    IS2_atl03_attrs[gtx]['heights'][key] = {}
-                    for att_name, att_val in val.attrs.items():
-                        IS2_atl03_attrs[gtx]['heights'][key][att_name] = att_val
-                # -- ICESat-2 Geolocation Group
-                for key, val in fileID[gtx]['geolocation'].items():
-                    IS2_atl03_attrs[gtx]['geolocation'][key] = {}
-                    for att_name, att_val in val.attrs.items():
-                        IS2_atl03_attrs[gtx]['geolocation'][key][att_name] = att_val
-                # -- ICESat-2 Background Photon Rate Group
-                # for key,val in fileID[gtx]['bckgrd_atlas'].items():
-                #     IS2_atl03_attrs[gtx]['bckgrd_atlas'][key] = {}
-                #     for att_name,att_val in val.attrs.items():
-                #         IS2_atl03_attrs[gtx]['bckgrd_atlas'][key][att_name]=att_val
-                # -- ICESat-2 Geophysical Corrections Group
-                for key, val in fileID[gtx]['geophys_corr'].items():
-                    IS2_atl03_attrs[gtx]['geophys_corr'][key] = {}
-                    for att_name, att_val in val.attrs.items():
-                        IS2_atl03_attrs[gtx]['geophys_corr'][key][att_name] = att_val
-
             # Ok, now write to csv files
-            for gtx in IS2_atl03_beams:
-
-                # Put data in pandas df
-                df_data = pd.DataFrame()
-                df_data['delta_time'] = IS2_atl03_mds[gtx]['heights']["delta_time"]
-                df_data['h_ph'] = IS2_atl03_mds[gtx]['heights']["h_ph"]
-                df_data['lat_ph'] = IS2_atl03_mds[gtx]['heights']["lat_ph"]
-                df_data['lon_ph'] = IS2_atl03_mds[gtx]['heights']["lon_ph"]
-
-                # This finds the maximum confidence value of any category
-                df_data['signal_conf_ph'] = np.amax(IS2_atl03_mds[gtx]['heights']["signal_conf_ph"], axis=1)
-
-                # Put reference information in pandas df
-
-                df_ref = pd.DataFrame()
-                df_ref['ref_lat'] = IS2_atl03_mds[gtx]['geolocation']['reference_photon_lat']
-                df_ref['ref_lon'] = IS2_atl03_mds[gtx]['geolocation']['reference_photon_lon']
-                df_ref['ref_geoid'] = IS2_atl03_mds[gtx]['geophys_corr']['geoid']
-                df_ref['ref_tide'] = IS2_atl03_mds[gtx]['geophys_corr']['tide_ocean']
-                df_ref['ref_dem'] = IS2_atl03_mds[gtx]['geophys_corr']['dem_h']
-
-                # Remove NAs
-                df_ref = df_ref[df_ref['ref_geoid'] < 90]
-                df_ref = df_ref[df_ref['ref_geoid'] > -105]
-
-                # Remove data outside reference scope
-                df_data = df_data[df_data['lat_ph'] > min(df_ref['ref_lat'])]
-                df_data = df_data[df_data['lat_ph'] < max(df_ref['ref_lat'])]
-
-                # Remove data with low confidence - 3 is medium confidence, 4 is high confidence
-                df_data = df_data[df_data['signal_conf_ph'] >= 3]
-
-                # Interpolate geoid heights to photon latitudesC
-                x = df_ref['ref_lat'].to_numpy()
-                y = df_ref['ref_geoid'].to_numpy()
-                f = scipy.interpolate.interp1d(x, y)
-                x_new = df_data['lat_ph']
-                y_new = f(x_new)
-                df_data['geoid'] = y_new
-
-                # Interpolate tide heights to photon latitudes
-                x = df_ref['ref_lat'].to_numpy()
-                y = df_ref['ref_tide'].to_numpy()
-                f = scipy.interpolate.interp1d(x, y)
-                x_new = df_data['lat_ph']
-                y_new = f(x_new)
-                df_data['tide'] = y_new
-
-                # Interpolate DEM heights to photon latitudes
-                x = df_ref['ref_lat'].to_numpy()
-                y = df_ref['ref_dem'].to_numpy()
-                f = scipy.interpolate.interp1d(x, y)
-                x_new = df_data['lat_ph']
-                y_new = f(x_new)
-                df_data['dem'] = y_new
-
-                # Not applying tide here, because we want the location relative to the geoid (msl)
-                df_data['elev'] = df_data['h_ph'] - df_data['geoid']
-
-                # Remove data outside reasonable boundaries
-                df_data = df_data[df_data['elev'] > -12000]
-                df_data = df_data[df_data['lat_ph'] < 9000]
-
-                if utm:
-                    # Find UTM zone to reproject to:
-                    zoneToUse = math.ceil((df_data["lon_ph"].mean() + 180) / 6)
-                    if df_data["lat_ph"].mean() > 0:
-                        outEPSG = str(326) + str(zoneToUse)
-                        zone = str(zoneToUse) + "N"
-                    else:
-                        outEPSG = str(327) + str(zoneToUse)
-                        zone = str(zoneToUse) + "S"
-
-                    transformer = Transformer.from_crs("epsg:4326", "epsg:" + outEPSG)
-                    df_data["x"], df_data["y"] = transformer.transform(df_data["lat_ph"].to_numpy(),
-                                                                       df_data["lon_ph"].to_numpy())
-
-                # Remove irrelevant photons (deeper than 50m, higher than 20m)
-                if removeIrrelevant:
-                    df_data = df_data[(df_data["elev"] > minElev) & (df_data["elev"] < maxElev)]
-
-                if removeLand:  # Remove photons for which the DEM is more than 50m above the geoid
-                    df_data = df_data[(df_data["dem"] - df_data["geoid"] < 50)]
-
-                # Remove unwanted columns
-                df = df_data.drop(['delta_time', 'h_ph', 'geoid', 'dem'], axis=1)
-
-                # Add class column
-                df['class'] = np.full((len(df)), 3)
-
-                # Set nodata to 0 for tides (slightly dangerous)
-                tides = np.array(df['tide'].values.tolist())
-                df['tide'] = np.where(tides > 1000, 0, tides).tolist()
-
-                if utm:
-                    df['lat'] = df['lat_ph']  # Keeping lat and lon here for reference
-                    df['lon'] = df['lon_ph']
-                    df = df.drop(['lat_ph', 'lon_ph'], axis=1)
-                    df = df[['x', 'y', 'lon', 'lat', 'elev', 'tide', 'signal_conf_ph',
-                             'class']]  # Change the order of the columns
-                else:
-                    df['lat'] = df['lat_ph']
-                    df['lon'] = df['lon_ph']
-                    df = df.drop(['lat_ph', 'lon_ph'], axis=1)
-                    df = df[
-                        ['lon', 'lat', 'elev', 'tide', 'signal_conf_ph', 'class']]  # Change the order of the columns
-
-                # Do normalization so all values are between 0 and 1
-                # df = (df - df.min()) / (df.max() - df.min())
-
-                # Round to three decimals for all variables
-                # df = df.round(decimals=3)
-
-                # Find water surface
-                df_segment_all = pd.DataFrame(columns=df.columns)
-                num = math.ceil((df['y'].max() - df['y'].min()) / interval)
-                y1 = df['y'].min()
-                for i in range(num):
-                    y2 = y1 + interval
-                    df_segment = df[(df['y'] >= y1) & (df['y'] < y2)].copy()
-                    if not df_segment.empty:
-                        df_segment = findSurface(df_segment, minElev, maxElev)
-                    df_segment_all = pd.concat([df_segment_all, df_segment], ignore_index=True)
-                    y1 = y2
-                df = df_segment_all
-
-                # Write data to csv file
-                if utm:
-                    outFilename = output_dir + "/" + os.path.basename(filename)[
-                                              :-3] + "_" + gtx + "_raw_" + zone + ".csv"  # Reinstate if
-                else:
-                    outFilename = output_dir + "/" + os.path.basename(filename)[:-3] + "_" + gtx + "_raw" + ".csv"
-                df.to_csv(outFilename, index=False)
+            for gtx in listBeams(fileID):
+                outFilename, attrs = convertBeam(fileID, gtx, output_dir, **kwargs)
+                if outFilename is not None:
+                    outFilenames.append(outFilename)
+                if readAttributes:
+                    IS2_atl03_attrs.setdefault(filename, {})[gtx] = attrs
+
+        basename = os.path.basename(filename)
+        manifest[basename] = manifestEntry(filename, output_dir, params, outFilenames, manifest.get(basename))
+        saveManifest(output_dir, manifest)
 
         # Move the original files to new folder
         # new_filename = os.path.join(dir, os.path.basename(filename))
@@ -296,6 +864,9 @@ def convert(dataDir, utm=True, removeLand=True, removeIrrelevant=True, interval=
 
         # print("H5 to CSV done!")
 
+    return IS2_atl03_attrs
+
+
 def main(args):
     dataDir = args.data_dir
     utm = args.utm
@@ -304,7 +875,22 @@ def main(args):
     interval = args.interval
     maxElev = args.maxElev
     minElev = args.minElev
-    convert(dataDir, utm=utm, removeLand=removeLand, removeIrrelevant=removeIrrelevant, interval=interval, maxElev=maxElev, minElev=minElev)
+    readAttributes = args.readAttributes
+    workers = args.workers
+    chunkSize = args.chunkSize
+    corrections = args.corrections
+    surface = args.surface
+    report = args.surfaceReport
+    outFormat = args.format
+    force = args.force
+    alongTrack = args.alongTrack
+    projectionThreads = args.projectionThreads
+    bbox = args.bbox
+    latRange = args.latRange
+    convert(dataDir, utm=utm, removeLand=removeLand, removeIrrelevant=removeIrrelevant, interval=interval, maxElev=maxElev, minElev=minElev,
+            readAttributes=readAttributes, workers=workers, chunkSize=chunkSize, corrections=corrections,
+            surface=surface, report=report, outFormat=outFormat, force=force, alongTrack=alongTrack,
+            projectionThreads=projectionThreads, bbox=bbox, latRange=latRange)
 
 
 if __name__ == '__main__':
@@ -1,10 +1,17 @@
 # Yiwen Lin, September 2022
 # Pass annotation to original beam files and split files by equal number
 
-import os, math, glob
+import os, sys, math, glob, re
+import concurrent.futures
 import pandas as pd
 import numpy as np
 import argparse
+from scipy.spatial import cKDTree
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(basedir)
+from data_utils.table_io import read_table, is_table
+from data_utils.shard_io import ShardWriter
 
 
 def find_seafloor(file_list):
@@ -32,106 +39,325 @@ def find_seafloor(file_list):
     return seafloor_dict
 
 
-def annotate_seafloor(df, seafloor_loc_h):
-    if len(seafloor_loc_h) > 0:
-        # method 1
-        df_loc = df.loc[:, ["y", "elev"]].to_numpy().tolist()
-        for i, item in enumerate(df_loc):
-            if item in seafloor_loc_h:
-                df.loc[i, "annotation"] = 1
-            # elif item in seafloor_loc_l:
-            #     df.loc[i, "annotation"] = 2
+def location_keys(y, elev, decimals=None):
+    # hashable (y, elev) keys of points; with decimals, locations that agree when rounded get the same key
+    y = np.asarray(y, dtype=np.float64)
+    elev = np.asarray(elev, dtype=np.float64)
+    if decimals is not None:
+        y = np.round(y, decimals)
+        elev = np.round(elev, decimals)
+    return pd.MultiIndex.from_arrays([y, elev])
+
+
+class SeafloorMatcher:
+    # Matches beam points to the annotated seafloor locations of a track, built once per track from the find_seafloor
+    # output. Without a tolerance, points match by a hash join on (y, elev), exact or after rounding to decimals. With a
+    # tolerance (m), a point matches if an annotated location lies within that distance in (y, elev), found with a
+    # KD-tree. The annotated locations that matched any point are kept track of, so the unmatched ones can be reported
+    def __init__(self, seafloor_loc, tolerance=None, decimals=None):
+        self.seafloor_loc = np.asarray(seafloor_loc, dtype=np.float64).reshape(-1, 2)
+        self.tolerance = tolerance
+        self.decimals = decimals
+        self.matched = np.zeros(len(self.seafloor_loc), dtype=bool)
+        if tolerance is not None:
+            self.tree = cKDTree(self.seafloor_loc)
+        else:
+            self.keys = location_keys(self.seafloor_loc[:, 0], self.seafloor_loc[:, 1], decimals)
+
+    def match(self, y, elev):
+        # boolean mask of the points on an annotated seafloor location
+        if len(self.seafloor_loc) == 0 or len(y) == 0:
+            return np.zeros(len(y), dtype=bool)
+        if self.tolerance is None:
+            keys = location_keys(y, elev, self.decimals)
+            self.matched |= self.keys.isin(keys)
+            return keys.isin(self.keys)
+        # cKDTree only returns neighbours closer than distance_upper_bound, so make the tolerance itself inclusive
+        bound = np.nextafter(self.tolerance, np.inf)
+        points = np.column_stack([np.asarray(y, dtype=np.float64), np.asarray(elev, dtype=np.float64)])
+        dist, _ = self.tree.query(points, distance_upper_bound=bound)
+        dist_loc, _ = cKDTree(points).query(self.seafloor_loc, distance_upper_bound=bound)
+        self.matched |= np.isfinite(dist_loc)
+        return np.isfinite(dist)
+
+    def unmatched(self):
+        return self.seafloor_loc[~self.matched]
+
+
+def annotate_seafloor(df, seafloor_loc_h, decimals=None, tolerance=None):
+    # seafloor_loc_h is a list of (y, elev) seafloor locations, or a SeafloorMatcher built from one
+    if not isinstance(seafloor_loc_h, SeafloorMatcher):
+        seafloor_loc_h = SeafloorMatcher(seafloor_loc_h, tolerance=tolerance, decimals=decimals)
+    if len(seafloor_loc_h.seafloor_loc) > 0:
+        df.loc[seafloor_loc_h.match(df["y"].to_numpy(), df["elev"].to_numpy()), "annotation"] = 1
 
     return df
 
 
-def split_by_npoints(file_list, output_dir, mode='train', npoints=8192, overwrite=True):
-    if not os.path.exists(output_dir):
-        os.mkdir(output_dir)
-    for file in file_list:
-        df = pd.read_csv(file)
-        df["signal_conf_ph"] = df["signal_conf_ph"] - 2
-        file_base = os.path.basename(file)
+def report_unmatched(matchers, unmatched_file=None):
+    # print how many annotated seafloor locations of each track didn't match any beam point, and optionally save them
+    df_unmatched = []
+    for track, matcher in matchers.items():
+        unmatched = matcher.unmatched()
+        if len(unmatched) > 0:
+            print("Warning, %d of %d annotated seafloor points of track %s were not matched"
+                  % (len(unmatched), len(matcher.seafloor_loc), track))
+            df_unmatched.append(pd.DataFrame({"track": track, "y": unmatched[:, 0], "elev": unmatched[:, 1]}))
+    df_unmatched = pd.concat(df_unmatched, ignore_index=True) if df_unmatched else \
+        pd.DataFrame(columns=["track", "y", "elev"])
+    if unmatched_file:
+        df_unmatched.to_csv(unmatched_file, index=None, sep=',')
+    return df_unmatched
 
-        # get number of row
-        nrow = df.shape[0]
-        # get number of sub-files
-        nsubregion = math.ceil(nrow / npoints)
-        # store the start and end index of each sub-file into a list
-        subregion_index = []
-        if nsubregion > 1:
-            for j in range(nsubregion - 1):
-                start_index = j * npoints
-                end_index = (j + 1) * npoints
-                index = (start_index, end_index)
-                subregion_index.append(index)
-        # for last sub-file or for files that have less than 40000 points; discard the files of only 1 point
-        j = nsubregion - 1
-        start_index = j * npoints
-        end_index = nrow
-        if end_index - start_index > 1:
+
+def npoints_index(nrow, npoints=8192, stride=None):
+    if stride is not None and stride < npoints:
+        return sliding_index(nrow, npoints, stride)
+    # get number of sub-files
+    nsubregion = math.ceil(nrow / npoints)
+    # store the start and end index of each sub-file into a list
+    subregion_index = []
+    if nsubregion > 1:
+        for j in range(nsubregion - 1):
+            start_index = j * npoints
+            end_index = (j + 1) * npoints
             index = (start_index, end_index)
             subregion_index.append(index)
+    # for last sub-file or for files that have less than 40000 points; discard the files of only 1 point
+    j = nsubregion - 1
+    start_index = j * npoints
+    end_index = nrow
+    if end_index - start_index > 1:
+        index = (start_index, end_index)
+        subregion_index.append(index)
+    return subregion_index
 
-        for i in range(len(subregion_index)):
-            if mode == 'test':
-                df_subregion = df.iloc[subregion_index[i][0]:subregion_index[i][1],
-                    df.columns.get_indexer(["x", "y", "elev", "lon", "lat", "class", "signal_conf_ph"])]
-                output_filename = os.path.splitext(file_base)[0] + '_' + str(i + 1).zfill(2) + '.txt'
-                output_file_path = os.path.join(output_dir, output_filename)
-                # output file to pointnet++ input data format
-                if output_file_path and not overwrite:
-                    continue
-                df_subregion.to_csv(output_file_path, header=None, index=None, sep=' ')
-            elif mode == 'train':
-                df["annotation"] = 0
-                df_subregion = df.iloc[subregion_index[i][0]:subregion_index[i][1],
-                    df.columns.get_indexer(["x", "y", "elev", "lon", "lat", "class", "signal_conf_ph",
-                                            "annotation"])]
-                output_filename = os.path.splitext(file_base)[0] + '_' + str(i + 1).zfill(2) + '.txt'
-                output_file_path = os.path.join(output_dir, output_filename)
-                # output file to pointnet++ input data format
-                if output_file_path and not overwrite:
-                    continue
-                df_subregion.to_csv(output_file_path, header=None, index=None, sep=' ')
-            else:
-                df["annotation"] = 0
-                df_subregion = df.iloc[subregion_index[i][0]:subregion_index[i][1],
-                    df.columns.get_indexer(["x", "y", "elev", "lon", "lat", "class", "signal_conf_ph",
-                                            "annotation"])]
-                output_filename = os.path.splitext(file_base)[0] + '_' + str(i + 1).zfill(2) + '.csv'
-                output_file_path = os.path.join(output_dir, output_filename)
-                if output_file_path and not overwrite:
-                    continue
-                df_subregion.to_csv(output_file_path, index=None, sep=',')
 
+def sliding_index(nrow, npoints=8192, stride=4096):
+    # overlapping sub-files of npoints points, starting every stride points; the last one ends at the last point, so
+    # every sub-file is complete. Files of less than npoints points give a single sub-file (discarded if only 1 point)
+    if nrow <= npoints:
+        return [(0, nrow)] if nrow > 1 else []
+    starts = list(range(0, nrow - npoints, stride)) + [nrow - npoints]
+    return [(start_index, start_index + npoints) for start_index in starts]
+
+
+def along_track(df):
+    # along-track position of each point: dist_along if the beam file has it (ATL03_h5_to_csv --alongTrack), otherwise y
+    column = 'dist_along' if 'dist_along' in df.columns else 'y'
+    return df[column].to_numpy()
+
+
+def distance_index(along, tile_length=1000, npoints=None):
+    # sub-files of consecutive points spanning at most tile_length m along-track each: a new sub-file starts at the first
+    # point that would make the span of the current one longer, so beam files that aren't strictly sorted along-track
+    # are split fine as well. With npoints, sub-files with more points are split evenly into parts of at most npoints,
+    # so no points are lost to subsampling. Sub-files of only 1 point are discarded, as with npoints_index
+    nrow = len(along)
+    bounds = [0]
+    while bounds[-1] < nrow:
+        start_index = bounds[-1]
+        # running span from the start of the sub-file, over a growing number of points until it gets too long
+        length = 4096
+        while True:
+            part = along[start_index:start_index + length]
+            span = np.fmax.accumulate(part) - np.fmin.accumulate(part)
+            too_long = np.nonzero(span > tile_length)[0]
+            if len(too_long) > 0 or start_index + length >= nrow:
+                break
+            length *= 2
+        bounds.append(start_index + too_long[0] if len(too_long) > 0 else nrow)
+
+    subregion_index = []
+    for start_index, end_index in zip(bounds[:-1], bounds[1:]):
+        nparts = math.ceil((end_index - start_index) / npoints) if npoints else 1
+        parts = np.linspace(start_index, end_index, nparts + 1).round().astype(int)
+        for part_start, part_end in zip(parts[:-1], parts[1:]):
+            if part_end - part_start > 1:
+                subregion_index.append((int(part_start), int(part_end)))
     return subregion_index
 
 
+def split_index(df, split_method='npoints', npoints=8192, stride=None, tile_length=1000):
+    # start and end index of each sub-file of a beam: by number of points ('npoints'), by along-track distance
+    # ('distance') or by along-track distance with at most npoints points per sub-file ('adaptive')
+    if split_method == 'distance':
+        return distance_index(along_track(df), tile_length)
+    elif split_method == 'adaptive':
+        return distance_index(along_track(df), tile_length, npoints)
+    return npoints_index(df.shape[0], npoints, stride)
+
+
+# columns whose min/max are recorded for each sub-file in the tile index: the bounding box, and the normalization
+# bounds of the first three columns written to the sub-file (norm0-2), which the datasets normalize by position
+BOUND_COLUMNS = ['x', 'y', 'elev', 'lon', 'lat']
+NORM_COLUMNS = ['norm0', 'norm1', 'norm2']
+TILE_INDEX_COLUMNS = ['name', 'beam', 'tile', 'start', 'stop', 'npoints', 'seafloor', 'granule', 'gtx'] + \
+                     [column + suffix for column in BOUND_COLUMNS + NORM_COLUMNS for suffix in ('_min', '_max')]
+
+
+def tile_entry(name, beam, tile, start, stop, df_subregion, tile_columns, annotated=False):
+    # tile index entry of a sub-file: its photon range [start, stop) in the beam file, number of photons and of seafloor
+    # photons (left empty unless annotated), source granule and beam, and the min/max of its points, so sub-files can be
+    # selected, sampled and normalized without reading them. tile_columns are the columns in the order they are written
+    match = re.search(r'^(.*?)_(gt[1-3][lr])', beam)
+    granule, gtx = (match.group(1), match.group(2)) if match else (beam, '')
+    seafloor = int(np.count_nonzero(df_subregion['annotation'].to_numpy())) if annotated else None
+    values = df_subregion[BOUND_COLUMNS + tile_columns[:len(NORM_COLUMNS)]].to_numpy(dtype=np.float64)
+    if len(values):
+        bounds = np.column_stack([values.min(axis=0), values.max(axis=0)]).ravel()
+    else:
+        bounds = np.full(2 * (len(BOUND_COLUMNS) + len(NORM_COLUMNS)), np.nan)
+    return (name, beam, tile, start, stop, len(df_subregion), seafloor, granule, gtx) + tuple(bounds.tolist())
+
+
+def write_tile_index(tile_index, output_dir):
+    # tile index of the sub-files (see tile_entry); the photon ranges are also used to stitch overlapping predictions
+    pd.DataFrame(tile_index, columns=TILE_INDEX_COLUMNS).to_csv(
+        os.path.join(output_dir, 'tile_index.csv'), index=None, sep=',')
+
+
+def write_tile(df_subregion, output_file_path, **kwargs):
+    # write to a temporary file first, so an interrupted run never leaves a partial sub-file behind
+    df_subregion.to_csv(output_file_path + '.tmp', **kwargs)
+    os.replace(output_file_path + '.tmp', output_file_path)
+
+
+def split_file(file, output_dir, mode='train', npoints=8192, overwrite=True, stride=None, writer=None,
+               split_method='npoints', tile_length=1000):
+    # split a single beam file into sub-files; returns its number of photons and the tile index entries of its sub-files
+    df = read_table(file)
+    df["signal_conf_ph"] = df["signal_conf_ph"] - 2
+    if mode != 'test':
+        df["annotation"] = 0
+    file_base = os.path.basename(file)
+
+    # get number of row
+    nrow = df.shape[0]
+    subregion_index = split_index(df, split_method, npoints, stride, tile_length)
+
+    # columns of the sub-files, in the pointnet++ input data format
+    tile_columns = ["x", "y", "elev", "lon", "lat", "class", "signal_conf_ph"]
+    if mode != 'test':
+        tile_columns = tile_columns + ["annotation"]
+
+    tile_index = []
+    for i in range(len(subregion_index)):
+        # record the photons of the sub-file in the beam file
+        tile_index.append(tile_entry(os.path.splitext(file_base)[0] + '_' + str(i + 1).zfill(2) + '.txt',
+                                     os.path.splitext(file_base)[0], i + 1, subregion_index[i][0],
+                                     subregion_index[i][1], df.iloc[subregion_index[i][0]:subregion_index[i][1]],
+                                     tile_columns))
+        if mode == 'test':
+            df_subregion = df.iloc[subregion_index[i][0]:subregion_index[i][1], df.columns.get_indexer(tile_columns)]
+            output_filename = os.path.splitext(file_base)[0] + '_' + str(i + 1).zfill(2) + '.txt'
+            output_file_path = os.path.join(output_dir, output_filename)
+            if writer is not None:
+                writer.add(output_filename, df_subregion.to_numpy())
+                continue
+            # output file to pointnet++ input data format
+            if output_file_path and not overwrite:
+                continue
+            write_tile(df_subregion, output_file_path, header=None, index=None, sep=' ')
+        elif mode == 'train':
+            df_subregion = df.iloc[subregion_index[i][0]:subregion_index[i][1], df.columns.get_indexer(tile_columns)]
+            output_filename = os.path.splitext(file_base)[0] + '_' + str(i + 1).zfill(2) + '.txt'
+            output_file_path = os.path.join(output_dir, output_filename)
+            if writer is not None:
+                writer.add(output_filename, df_subregion.to_numpy())
+                continue
+            # output file to pointnet++ input data format
+            if output_file_path and not overwrite:
+                continue
+            write_tile(df_subregion, output_file_path, header=None, index=None, sep=' ')
+        else:
+            df_subregion = df.iloc[subregion_index[i][0]:subregion_index[i][1], df.columns.get_indexer(tile_columns)]
+            output_filename = os.path.splitext(file_base)[0] + '_' + str(i + 1).zfill(2) + '.csv'
+            output_file_path = os.path.join(output_dir, output_filename)
+            if output_file_path and not overwrite:
+                continue
+            write_tile(df_subregion, output_file_path, index=None, sep=',')
+
+    return nrow, tile_index
+
+
+def tile_summary(file_list, results):
+    # number of photons and sub-files of each beam file
+    summary = []
+    for file, (nrow, tile_index) in zip(file_list, results):
+        summary.append((os.path.splitext(os.path.basename(file))[0], file, nrow, len(tile_index)))
+    return pd.DataFrame(summary, columns=['beam', 'file', 'photons', 'tiles'])
+
+
+def split_by_npoints(file_list, output_dir, mode='train', npoints=8192, overwrite=True, shard=None, stride=None,
+                     workers=1, split_method='npoints', tile_length=1000):
+    # with shard, the 'test' and 'train' tiles are packed into the shard of that name in output_dir instead of being
+    # written to .txt files. With a stride smaller than npoints the sub-files overlap; split_method selects splitting by
+    # along-track distance instead (see split_index). Beam files are split on workers processes, except when packing
+    # into a shard, which is written by a single process
+    if mode == 'test' and split_method == 'distance':
+        # predict.py subsamples sub-files of more than npoints points, so part of their photons would get no prediction
+        # and the photon ranges in the tile index would no longer match the predicted photons
+        raise ValueError("split_method 'distance' can give sub-files of more than npoints points, which can't be "
+                         "predicted; use 'adaptive' for the test mode")
+    if not os.path.exists(output_dir):
+        os.mkdir(output_dir)
+    writer = ShardWriter(output_dir, shard) if shard and mode in ('test', 'train') else None
+    if workers > 1 and writer is None and len(file_list) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            jobs = [executor.submit(split_file, file, output_dir, mode, npoints, overwrite, stride, None, split_method,
+                                    tile_length) for file in file_list]
+            results = [job.result() for job in jobs]
+    else:
+        results = [split_file(file, output_dir, mode, npoints, overwrite, stride, writer, split_method, tile_length)
+                   for file in file_list]
+
+    if writer is not None:
+        writer.close()
+    tile_index = [entry for nrow, entries in results for entry in entries]
+    summary = tile_summary(file_list, results)
+    if mode in ('test', 'train'):
+        write_tile_index(tile_index, output_dir)
+        summary.to_csv(os.path.join(output_dir, 'tile_summary.csv'), index=None, sep=',')
+    print("%d sub-files from %d beam files, %d photons" % (len(tile_index), len(summary), summary['photons'].sum()))
+
+    return tile_index
+
+
 # setting
 parser = argparse.ArgumentParser(description='Generate training files')
 parser.add_argument('input_dir', help='Input directory')
 parser.add_argument('output_dir', help='Output directory')
-parser.add_argument('--split_method', help='The split method for generating subset files, choose between npoints or latitude')
+parser.add_argument('--split_method', default='npoints', choices=['npoints', 'distance', 'adaptive'],
+                    help='The split method for generating subset files: by number of points, by along-track distance, '
+                         'or by along-track distance with at most npoints points per file')
 parser.add_argument('--npoints', type=int, default=8192, help='Number of points used for splitting')
+parser.add_argument('--stride', type=int, default=None, help='Start a sub-file every stride points, so they overlap if smaller than npoints')
 parser.add_argument('--itvlat', type=int, default=1, help='Interval of latitude used for splitting')
+parser.add_argument('--tile_length', type=float, default=1000, help='Along-track length (m) of the subset files for the distance split methods')
 parser.add_argument('--overwrite', action='store_true', help='Whether overwrite the existing output files or not')
 parser.add_argument('--split_flag', action='store_true')
+parser.add_argument('--decimals', type=int, default=None,
+                    help='Match annotated points to beam points after rounding y and elev to this many decimals')
+parser.add_argument('--tolerance', type=float, default=None,
+                    help='Match annotated points to beam points within this distance (m) in y and elev')
+parser.add_argument('--unmatched_file', type=str, default=None,
+                    help='Csv file for the annotated points that did not match any beam point')
 
 
-def generate_annotation(dir1, output_dir, split_method='npoints', npoints=8192, lat_interval=None, overwrite=True, split_flag=True):
+def generate_annotation(dir1, output_dir, split_method='npoints', npoints=8192, lat_interval=None, overwrite=True, split_flag=True,
+                        decimals=None, tolerance=None, unmatched_file=None, stride=None, tile_length=1000):
     # annotation file list
     file_list_h = []
     file_list_l = []
 
     # original file list
     file_list = []
-    file_all = glob.glob(dir1 + '*.csv')
+    file_all = glob.glob(dir1 + '*')
     for file in file_all:
         # find original beam files based on file name and extension
         fname = os.path.splitext(os.path.basename(file))[0]
-        ext = os.path.splitext(os.path.basename(file))[1]
-        if ext == '.csv' and 'annotated' not in fname:
+        if is_table(file) and 'annotated' not in fname:
             file_list.append(file)
     for file in file_list:
         filename = os.path.splitext(os.path.basename(file))[0]
@@ -151,6 +377,8 @@ def generate_annotation(dir1, output_dir, split_method='npoints', npoints=8192,
     # print("Finding seafloor point locations from annotation files...")
     # for high probability annotation
     seafloor_dict_h = find_seafloor(file_list_h)
+    matchers_h = {track: SeafloorMatcher(seafloor_loc, tolerance=tolerance, decimals=decimals)
+                  for track, seafloor_loc in seafloor_dict_h.items()}
     # for low probability annotation
     # seafloor_dict_l = find_seafloor(file_list_l)
 
@@ -158,8 +386,9 @@ def generate_annotation(dir1, output_dir, split_method='npoints', npoints=8192,
     # print("Generating files with annotation...")
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
+    tile_index = []
     for file in file_list:
-        df = pd.read_csv(file)
+        df = read_table(file)
         file_base = os.path.basename(file)
         # pass annotation
         # at first annotate every point as '0'
@@ -169,7 +398,7 @@ def generate_annotation(dir1, output_dir, split_method='npoints', npoints=8192,
         for track in ['1l', '1r', '2l', '2r', '3l', '3r']:
             if track in file_base:
                 # find seafloor points and annotate them as '1'
-                df = annotate_seafloor(df, seafloor_dict_h[track])
+                df = annotate_seafloor(df, matchers_h[track])
                 break
 
         if split_flag is False:
@@ -181,18 +410,19 @@ def generate_annotation(dir1, output_dir, split_method='npoints', npoints=8192,
 
         else:
             # split files - output training files
-            # split by npoints or latitude
-            if split_method == 'npoints':
-                subregion_index = split_by_npoints(df, npoints=npoints)
+            # split by npoints or along-track distance
+            if split_method in ('npoints', 'distance', 'adaptive'):
+                subregion_index = split_index(df, split_method, npoints=npoints, stride=stride, tile_length=tile_length)
             else:
                 # subregion_index = split_by_lat(df, lat_interval=lat_interval)
-                print('Currently only support splitting by number of points')
+                print('Currently only support splitting by number of points or along-track distance')
+                subregion_index = []
 
             # output each sub-file
+            tile_columns = ["x", "y", "lon", "lat", "elev", "signal_conf_ph", "class", "annotation"]
             for i in range(len(subregion_index)):
                 df_subregion = df.iloc[subregion_index[i][0]:subregion_index[i][1],
-                               df.columns.get_indexer(["x", "y", "lon", "lat", "elev", "signal_conf_ph", "class",
-                                                       "annotation"])]
+                               df.columns.get_indexer(tile_columns)]
 
                 # if contains seafloor points, add '_seafloor' to filename
                 if np.any(df_subregion["annotation"].to_numpy() != 0):
@@ -201,12 +431,19 @@ def generate_annotation(dir1, output_dir, split_method='npoints', npoints=8192,
                     output_filename = os.path.splitext(file_base)[0] + '_' + str(i + 1).zfill(2) + '.txt'
 
                 output_file_path = os.path.join(output_dir, output_filename)
+                tile_index.append(tile_entry(output_filename, os.path.splitext(file_base)[0], i + 1,
+                                             subregion_index[i][0], subregion_index[i][1], df_subregion, tile_columns,
+                                             True))
                 # output file to pointnet++ input data format
                 if output_file_path and not overwrite:
                     print(output_file_path + " already exists, skip")
                     continue
                 df_subregion.to_csv(output_file_path, header=None, index=None, sep=' ')
 
+    if split_flag:
+        write_tile_index(tile_index, output_dir)
+    return report_unmatched(matchers_h, unmatched_file)
+
 
 def main(args):
     # parse arguments
@@ -216,9 +453,15 @@ def main(args):
     npoints = args.npoints
     lat_interval = args.itvlat
     overwrite = args.overwrite
-    split_flag = args.split_flags
+    split_flag = args.split_flag
+    decimals = args.decimals
+    tolerance = args.tolerance
+    unmatched_file = args.unmatched_file
+    stride = args.stride
+    tile_length = args.tile_length
     generate_annotation(dir1, output_dir, split_method=split_method, npoints=npoints, lat_interval=lat_interval,
-                        overwrite=overwrite, split_flag=split_flag)
+                        overwrite=overwrite, split_flag=split_flag, decimals=decimals, tolerance=tolerance,
+                        unmatched_file=unmatched_file, stride=stride, tile_length=tile_length)
 
 
 if __name__ == '__main__':
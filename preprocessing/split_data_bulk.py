@@ -7,14 +7,39 @@ import argparse
 
 basedir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(basedir)
+sys.path.append(os.path.dirname(basedir))
+from data_utils.table_io import is_table
 
 # setting
 parser = argparse.ArgumentParser(description='Convert ATL03 to CSV file')
 parser.add_argument('--input_dir', type=str, required=True, help='Input directory')
 parser.add_argument('--mode', type=str, default='train', help='Data splitting mode')
+parser.add_argument('--npoints', type=int, default=8192, help='Number of points of each sub-file')
+parser.add_argument('--split_method', type=str, default='npoints', choices=['npoints', 'distance', 'adaptive'],
+                    help='Split by number of points, by along-track distance, or by along-track distance with at most '
+                         'npoints points per sub-file')
+parser.add_argument('--tile_length', type=float, default=1000,
+                    help='Along-track length (m) of a sub-file for the distance split methods')
+parser.add_argument('--stride', type=int, default=None,
+                    help='Start a sub-file every stride points, so they overlap if smaller than npoints')
+parser.add_argument('--workers', type=int, default=1, help='Number of processes splitting beam files in parallel')
+parser.add_argument('--pack', action='store_true', help='Pack the test mode tiles into a single shard (input_data/predict_*)')
 
 
-def split(input_dir, mode='train'):
+def plan_split(input_dir):
+    # original beam files, found based on file name and extension. A beam that is there in several formats (e.g. after
+    # converting again with another --format) is split only once, from its most recent file
+    beams = {}
+    for file in sorted(glob.glob(os.path.join(input_dir, 'csv_data', '*'))):
+        fname = os.path.splitext(os.path.basename(file))[0]
+        if is_table(file) and (fname.endswith('N') or fname.endswith('S')):
+            if fname not in beams or os.path.getmtime(file) > os.path.getmtime(beams[fname]):
+                beams[fname] = file
+    return [beams[fname] for fname in sorted(beams)]
+
+
+def split(input_dir, mode='train', pack=False, npoints=8192, stride=None, workers=1, split_method='npoints',
+          tile_length=1000):
     print("Start splitting data...")
 
     if mode == 'train' or mode == 'manual':
@@ -31,25 +56,18 @@ def split(input_dir, mode='train'):
 
     generate_training_data = importlib.import_module('generate_training_data')
 
-    sub_dirs = glob.glob(input_dir+'/csv_data/')
-    for sub_dir in sub_dirs:
-        # original file list
-        file_list = []
-        file_all = glob.glob(sub_dir + '/*')
-        for file in file_all:
-            # find original beam files based on file name and extension
-            fname = os.path.splitext(os.path.basename(file))[0]
-            ext = os.path.splitext(os.path.basename(file))[1]
-            if fname.endswith('N') or fname.endswith('S'):
-                file_list.append(file)
-            generate_training_data.split_by_npoints(file_list, output_dir, mode)
+    # discover the beam files once, then split them all in one go
+    file_list = plan_split(input_dir)
+    generate_training_data.split_by_npoints(file_list, output_dir, mode, npoints=npoints,
+                                            shard='predict' if pack and mode == 'test' else None, stride=stride,
+                                            workers=workers, split_method=split_method, tile_length=tile_length)
 
-        # generate_training_data.generate_annotation(sub_dir, output_dir, split_method='npoints', lat_interval=1, npoints=8192, overwrite=True)
+    # generate_training_data.generate_annotation(os.path.join(input_dir, 'csv_data/'), output_dir, split_method='npoints', lat_interval=1, npoints=8192, overwrite=True)
 
 
 def main(args):
     input_dir = args.input_dir
-    split(input_dir)
+    split(input_dir, args.mode, args.pack, args.npoints, args.stride, args.workers, args.split_method, args.tile_length)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,138 @@
+# Writes synthetic ATL03 granules (.h5) with the groups and variables ATL03_h5_to_csv reads, so the preprocessing can be
+# run and benchmarked without downloading real granules
+
+# Imports
+import os
+import argparse
+import h5py
+import numpy as np
+
+BEAMS = ['gt1l', 'gt1r', 'gt2l', 'gt2r', 'gt3l', 'gt3r']
+FILL_VALUE = np.float32(3.4028235e38)
+
+# setting
+parser = argparse.ArgumentParser(description='Generate synthetic ATL03 granules')
+parser.add_argument('--output_dir', type=str, required=True, help='Output directory')
+parser.add_argument('--granules', type=int, default=1, help='Number of granules')
+parser.add_argument('--photons', type=int, default=1000000, help='Number of photons of each strong beam')
+parser.add_argument('--weakRatio', type=float, default=0.25, help='Photons of a weak beam relative to a strong beam')
+parser.add_argument('--noise', type=float, default=0.3, help='Fraction of photons that are background noise')
+parser.add_argument('--maxDepth', type=float, default=30, help='Depth of the seafloor at the end of the track (m)')
+parser.add_argument('--land', type=float, default=0.1, help='Fraction of the track over land, at its end')
+parser.add_argument('--fillFraction', type=float, default=0.01, help='Fraction of segments with fill value corrections')
+parser.add_argument('--lat', type=float, default=24.6, help='Latitude of the start of the track')
+parser.add_argument('--lon', type=float, default=-81.0, help='Longitude of the start of the track')
+parser.add_argument('--seed', type=int, default=0)
+
+
+def seafloorProfile(nseg, maxDepth, rng):
+    # Seafloor elevation of each 20 m segment: a slope from 1 m to maxDepth deep with some rolling relief
+    t = np.arange(nseg) / max(nseg - 1, 1)
+    relief = np.sin(2 * np.pi * t * rng.uniform(2, 6)) * 0.05 * maxDepth
+    return -(1 + (maxDepth - 1) * t) + relief
+
+
+def writeBeam(group, nPhotons, lat0, lon0, rng, noise=0.3, maxDepth=30, land=0.1, fillFraction=0.01):
+    # Photons are spread over 20 m geolocation segments along a track heading north. Signal photons are returned from the
+    # water surface or the seafloor (or the ground over land), noise photons are uniform between -60 and +20 m
+    nseg = max(int(np.ceil(nPhotons / 20)), 1)
+    cnt = rng.multinomial(nPhotons, np.full(nseg, 1 / nseg)).astype(np.int32)
+    cnt[rng.random(nseg) < 0.01] = 0  # segments without any photons
+    cnt[0] += nPhotons - cnt.sum()
+    beg = np.zeros(nseg, dtype=np.int64)
+    first = np.cumsum(cnt) - cnt + 1  # ph_index_beg is 1-based, and 0 for empty segments
+    beg[cnt > 0] = first[cnt > 0]
+    seg = np.repeat(np.arange(nseg), cnt)
+
+    # Geolocation: segments of 20 m heading north with a slight eastward drift
+    seglat = lat0 + np.arange(nseg) * 20 / 111000
+    seglon = lon0 + np.arange(nseg) * 2e-6
+    offset = rng.random(nPhotons)
+    lat = seglat[seg] + offset * 20 / 111000
+    lon = seglon[seg] + offset * 2e-6
+
+    # Geophysical corrections per segment
+    geoid = (5 + 0.5 * np.sin(np.arange(nseg) / 300)).astype(np.float32)
+    tide = (0.3 * np.cos(np.arange(nseg) / 500)).astype(np.float32)
+    isLand = np.arange(nseg) >= nseg * (1 - land)
+    seafloor = seafloorProfile(nseg, maxDepth, rng)
+    dem = np.where(isLand, 100, seafloor).astype(np.float32)
+
+    # Heights above the ellipsoid
+    kind = rng.random(nPhotons)
+    isNoise = kind < noise
+    isSurface = ~isNoise & (kind < noise + (1 - noise) * 0.6) & ~isLand[seg]
+    surface = tide[seg] + rng.normal(0, 0.15, nPhotons)
+    bottom = np.where(isLand[seg], 100, seafloor[seg]) + rng.normal(0, 0.3, nPhotons)
+    h = np.where(isNoise, rng.uniform(-60, 20, nPhotons), np.where(isSurface, surface, bottom)) + geoid[seg]
+
+    # Confidence per surface type: signal photons are medium/high, noise is mostly low
+    conf = np.where(isNoise, rng.integers(0, 4, nPhotons), rng.integers(3, 5, nPhotons)).astype(np.int8)
+    conf = np.repeat(conf[:, None], 5, axis=1)
+    conf[:, 1:] = np.minimum(conf[:, 1:], rng.integers(0, 5, (nPhotons, 4)).astype(np.int8))
+
+    # Some segments have fill values, as in real granules
+    geoid[rng.random(nseg) < fillFraction] = FILL_VALUE
+    tide[rng.random(nseg) < fillFraction] = FILL_VALUE
+
+    heights = group.create_group('heights')
+    heights['delta_time'] = np.linspace(0, nseg * 20 / 7000, nPhotons)
+    heights['h_ph'] = h.astype(np.float32)
+    heights['lat_ph'] = lat
+    heights['lon_ph'] = lon
+    heights['signal_conf_ph'] = conf
+    heights['dist_ph_along'] = (offset * 20).astype(np.float32)
+    heights['h_ph'].attrs['units'] = 'meters'
+    heights['h_ph'].attrs['long_name'] = 'Photon WGS84 Height'
+
+    geolocation = group.create_group('geolocation')
+    geolocation['reference_photon_lat'] = seglat + 10 / 111000
+    geolocation['reference_photon_lon'] = seglon + 1e-6
+    geolocation['ph_index_beg'] = beg
+    geolocation['segment_ph_cnt'] = cnt
+    geolocation['segment_dist_x'] = 1e6 + np.arange(nseg) * 20.0
+    geolocation['segment_id'] = np.arange(nseg, dtype=np.int32) + 100000
+
+    geophys_corr = group.create_group('geophys_corr')
+    geophys_corr['geoid'] = geoid
+    geophys_corr['tide_ocean'] = tide
+    geophys_corr['dem_h'] = dem
+
+
+def writeGranule(filename, photons=1000000, weakRatio=0.25, noise=0.3, maxDepth=30, land=0.1, fillFraction=0.01,
+                 lat=24.6, lon=-81.0, seed=0):
+    # Write a granule with all six beams; the left beam of each pair is the strong one
+    rng = np.random.default_rng(seed)
+    with h5py.File(filename, mode='w') as fileID:
+        for i, gtx in enumerate(BEAMS):
+            group = fileID.create_group(gtx)
+            strong = gtx.endswith('l')
+            group.attrs['atlas_beam_type'] = np.bytes_('strong' if strong else 'weak')
+            nPhotons = photons if strong else max(int(photons * weakRatio), 1)
+            # beam pairs are 3.3 km apart, the beams of a pair 90 m
+            writeBeam(group, nPhotons, lat, lon + (i // 2) * 0.03 + (i % 2) * 0.0008, rng, noise=noise,
+                      maxDepth=maxDepth, land=land, fillFraction=fillFraction)
+    return filename
+
+
+def generate(outputDir, granules=1, photons=1000000, weakRatio=0.25, noise=0.3, maxDepth=30, land=0.1,
+             fillFraction=0.01, lat=24.6, lon=-81.0, seed=0):
+    if not os.path.exists(outputDir):
+        os.makedirs(outputDir)
+    filenames = []
+    for i in range(granules):
+        filename = os.path.join(outputDir, 'ATL03_20210101000000_%04d0101_005_01.h5' % i)
+        filenames.append(writeGranule(filename, photons=photons, weakRatio=weakRatio, noise=noise, maxDepth=maxDepth,
+                                      land=land, fillFraction=fillFraction, lat=lat, lon=lon, seed=seed + i))
+    return filenames
+
+
+def main(args):
+    generate(args.output_dir, granules=args.granules, photons=args.photons, weakRatio=args.weakRatio, noise=args.noise,
+             maxDepth=args.maxDepth, land=args.land, fillFraction=args.fillFraction, lat=args.lat, lon=args.lon,
+             seed=args.seed)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -5,7 +5,8 @@ cd $SOURCEDIR
 
 data_dir=256160621
 mode='train'
+workers=1
 
 ################################################
-python preprocessing/ATL03_h5_to_csv.py --data_dir ${data_dir} --removeLand --removeIrrelevant --utm
-python preprocessing/split_data_bulk.py --input_dir ${data_dir} --mode ${mode}
\ No newline at end of file
+python preprocessing/ATL03_h5_to_csv.py --data_dir ${data_dir} --removeLand --removeIrrelevant --utm --workers ${workers}
+python preprocessing/split_data_bulk.py --input_dir ${data_dir} --mode ${mode} --workers ${workers}
\ No newline at end of file
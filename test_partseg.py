@@ -8,7 +8,7 @@ Date: Jul 2023
 import argparse
 import os
 from pathlib import Path
-from data_utils.ShapeNetDataLoader import PartNormalDataset
+from data_utils.ShapeNetDataLoader import PartNormalDataset, pc_denormalize
 import torch
 import logging
 import sys
@@ -35,12 +35,6 @@ def to_categorical(y, num_classes):
     return new_y.to(y.device)
 
 
-def pc_denormalize(pc, pc_min, pc_max):
-    for i in range(pc.shape[1]):
-        pc[:, i] = (pc[:, i] + 1) / 2 * (pc_max[i] - pc_min[i]) + pc_min[i]
-    return pc
-
-
 def parse_args():
     '''PARAMETERS'''
     parser = argparse.ArgumentParser('PointNet')
@@ -54,6 +48,9 @@ def parse_args():
     parser.add_argument('--data_root', type=str, required=True, help='data root file')
     parser.add_argument('--output', action='store_false', help='output test results')
     parser.add_argument('--threshold', type=float, default=0.5, help='probability threshold')
+    parser.add_argument('--packed', action='store_true', default=False, help='read the tiles from packed shards')
+    parser.add_argument('--in_memory', action='store_true', default=False,
+                        help='load all tiles into shared memory, read by all data loader workers')
 
     return parser.parse_args()
 
@@ -92,7 +89,8 @@ def main(args):
 
     root = args.data_root
 
-    TEST_DATASET = PartNormalDataset(root=root, npoints=args.num_point, split='test', conf_channel=args.conf)
+    TEST_DATASET = PartNormalDataset(root=root, npoints=args.num_point, split='test', conf_channel=args.conf,
+                                     packed=args.packed, in_memory=args.in_memory)
     testDataLoader = torch.utils.data.DataLoader(TEST_DATASET, batch_size=args.batch_size, shuffle=False, num_workers=3)
     log_string("The number of test data is: %d" % len(TEST_DATASET))
     num_classes = 1
@@ -173,7 +171,7 @@ def main(args):
                     cur_pc_min = pc_min[i, :]
                     cur_pc_max = pc_max[i, :]
                     # recover other information
-                    data = np.loadtxt(fn[i]).astype(np.float64)
+                    data = TEST_DATASET.read_tile(fn[i])
                     cur_lonlat = data[:, [3, 4]]
                     # output points
                     output_points[:, 0:3] = pc_denormalize(output_points[:, 0:3], cur_pc_min, cur_pc_max)
@@ -13,6 +13,7 @@ from tqdm import tqdm
 import numpy as np
 from torch.utils.data import Dataset
 from sklearn.metrics import confusion_matrix
+from data_utils.ShapeNetDataLoader import pc_normalize, pc_denormalize
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = BASE_DIR
@@ -32,22 +33,6 @@ def to_categorical(y, num_classes):
     return new_y.to(y.device)
 
 
-def pc_denormalize(pc, pc_min, pc_max):
-    for i in range(pc.shape[1]):
-        pc[:, i] = (pc[:, i] + 1) / 2 * (pc_max[i] - pc_min[i]) + pc_min[i]
-    return pc
-
-
-def pc_normalize(pc):
-    pc_min = np.empty(3, dtype=np.float64)
-    pc_max = np.empty(3, dtype=np.float64)
-    for i in range(pc.shape[1]):
-        pc_min[i] = min(pc[:, i])
-        pc_max[i] = max(pc[:, i])
-        pc[:, i] = 2 * ((pc[:, i] - pc_min[i]) / (pc_max[i] - pc_min[i])) - 1
-    return pc, pc_min, pc_max
-
-
 class PartNormalDataset(Dataset):
     def __init__(self, root='./data', npoints=8192, conf_channel=True):
         self.npoints = npoints
@@ -97,7 +82,7 @@ class PartNormalDataset(Dataset):
 
         seg = data[:, -1].astype(np.int32)
 
-        point_set_normalized = point_set
+        point_set_normalized = point_set.copy()
         point_set_normalized[:, 0:3], pc_min, pc_max = pc_normalize(point_set[:, 0:3])
 
         point_set_normalized_mask = np.full(self.npoints, True, dtype=bool)
@@ -64,6 +64,11 @@ def parse_args():
     parser.add_argument('--data_root', type=str, required=True, help='data root file')
     parser.add_argument('--loss_weight', type=float, default=1.0, help='training loss weight')
     parser.add_argument('--early_stopping', action='store_true', default=False, help='use early stopping or not')
+    parser.add_argument('--packed', action='store_true', default=False, help='read the tiles from packed shards')
+    parser.add_argument('--in_memory', action='store_true', default=False,
+                        help='load all tiles into shared memory, read by all data loader workers')
+    parser.add_argument('--balanced_sampling', action='store_true', default=False,
+                        help='draw training tiles with and without seafloor equally often')
 
     return parser.parse_args()
 
@@ -118,10 +123,15 @@ def main(args):
 
     root = args.data_root
 
-    TRAIN_DATASET = PartNormalDataset(root=root, npoints=args.npoint, split='train', conf_channel=args.conf)
-    trainDataLoader = torch.utils.data.DataLoader(TRAIN_DATASET, batch_size=args.batch_size, shuffle=True,
-                                                  num_workers=3, drop_last=True)
-    VAL_DATASET = PartNormalDataset(root=root, npoints=args.npoint, split='val', conf_channel=args.conf)
+    TRAIN_DATASET = PartNormalDataset(root=root, npoints=args.npoint, split='train', conf_channel=args.conf,
+                                      packed=args.packed, in_memory=args.in_memory)
+    sampler = None
+    if args.balanced_sampling:
+        sampler = torch.utils.data.WeightedRandomSampler(TRAIN_DATASET.sample_weights(), len(TRAIN_DATASET))
+    trainDataLoader = torch.utils.data.DataLoader(TRAIN_DATASET, batch_size=args.batch_size, shuffle=sampler is None,
+                                                  sampler=sampler, num_workers=3, drop_last=True)
+    VAL_DATASET = PartNormalDataset(root=root, npoints=args.npoint, split='val', conf_channel=args.conf,
+                                    packed=args.packed, in_memory=args.in_memory)
     valDataLoader = torch.utils.data.DataLoader(VAL_DATASET, batch_size=args.batch_size, shuffle=False, num_workers=3)
     log_string("The number of training data is: %d" % len(TRAIN_DATASET))
     log_string("The number of val data is: %d" % len(VAL_DATASET))
@@ -4,12 +4,15 @@ Date: Jul 2023
 '''
 import os, json
 import argparse
+import pandas as pd
 from sklearn.model_selection import train_test_split
 from sklearn.utils import resample
+from data_utils.shard_io import pack_tiles
 
 # setting
 parser = argparse.ArgumentParser(description='Train-val-test data split')
 parser.add_argument('--data_dir', type=str, required=True, help='Input directory')
+parser.add_argument('--pack', action='store_true', help='Also pack the tiles of each split into a shard in input_data')
 
 
 def split_data(file_list):
@@ -45,10 +48,22 @@ def main(args):
     undersample_test = False
 
     data_dir = os.path.join(args.data_dir, 'input_data')
+    # seafloor photon counts from the tile index of generate_training_data.py, without opening the tiles; tiles that
+    # aren't in it (or not annotated when it was written) go by the _seafloor suffix of their name
+    seafloor = {}
+    index_file = os.path.join(data_dir, 'tile_index.csv')
+    if os.path.exists(index_file):
+        index = pd.read_csv(index_file)
+        if 'seafloor' in index.columns:
+            index = index.dropna(subset=['seafloor'])
+            seafloor = dict(zip(index['name'], index['seafloor'] > 0))
     file_list_sf = []
     file_list_non = []
     for file in os.listdir(data_dir):
-        if 'seafloor' in file:
+        # only the .txt tiles, not the shards packed next to them
+        if os.path.splitext(file)[1] != '.txt':
+            continue
+        if seafloor.get(file, 'seafloor' in file):
             file_list_sf.append(file)
         else:
             file_list_non.append(file)
@@ -71,6 +86,9 @@ def main(args):
         train_all = undersampled_files + train_list_sf
         print(len(train_all))
         create_json_file(train_all, val_all, test_all)
+        if args.pack:
+            for split, file_list in zip(['train', 'val', 'test'], [train_all, val_all, test_all]):
+                pack_tiles([os.path.join(data_dir, file) for file in sorted(file_list)], data_dir, split)
 
     else:
         undersampling_ratios = [0.1, 0.2, 0.3, 0.4, 0.5]